@@ -2,35 +2,812 @@ from flask import Flask, request, jsonify
 import locale
 from datetime import datetime
 import os
+import functools
+import json
+import queue
 import smtplib
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from email.mime.image import MIMEImage
+from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
 app = Flask(__name__)
 
+# Gabarits des e-mails (Alerts/templates), compilés une seule fois au démarrage
+EMAIL_TEMPLATE  = app.jinja_env.get_template("alert_email.html")
+GROUP_TEMPLATE  = app.jinja_env.get_template("alert_group.html")
+ALERT_TEMPLATE  = app.jinja_env.get_template("alert_fragment.html")
+FRAGMENT_CACHE_SIZE = int(os.getenv("WEBHOOK_FRAGMENT_CACHE", "1024"))
+_fragment_cache = OrderedDict()   # (fingerprint, statut, dates, annotations) -> HTML
+_fragment_lock  = threading.Lock()
 
-def send_email(subject, content, is_html=False):
+# Images intégrées aux e-mails (cid) : lues et encodées une fois, partagées par tous les messages.
+# Si un fichier manque, l'e-mail garde le lien distant d'origine.
+INLINE_IMAGES = {
+    "logo-comea": ("logo comea.svg", "svg+xml",
+                   "https://raw.githubusercontent.com/AurorAlpes/COMEA/b50d6143240d132a583bc5a4a45221bf163a812e/logo%20comea.svg"),
+    "bandeau":    ("Design sans titre.png", "png",
+                   "https://raw.githubusercontent.com/AurorAlpes/COMEA/refs/heads/main/Design%20sans%20titre.png"),
+}
+
+
+def load_inline_images():
+    parts, sources = [], {}
+    for cid, (filename, subtype, url) in INLINE_IMAGES.items():
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), filename)
+        if not os.path.exists(path):
+            sources[cid] = url
+            continue
+        with open(path, "rb") as f:
+            part = MIMEImage(f.read(), _subtype=subtype)
+        part.add_header("Content-ID", f"<{cid}>")
+        part.add_header("Content-Disposition", "inline", filename=filename)
+        parts.append(part)
+        sources[cid] = f"cid:{cid}"
+    return parts, sources
+
+
+IMAGE_PARTS, IMAGE_SRC = load_inline_images()
+
+# File d'envoi : réglages (variables d'environnement)
+SPOOL_DIR       = os.getenv("WEBHOOK_SPOOL_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "spool"))
+QUEUE_SIZE      = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+DELIVERY_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "2"))
+MAX_ATTEMPTS    = int(os.getenv("WEBHOOK_MAX_ATTEMPTS", "6"))
+RETRY_DELAY     = float(os.getenv("WEBHOOK_RETRY_DELAY", "30"))     # secondes, doublé à chaque échec
+MAX_RETRY_DELAY = float(os.getenv("WEBHOOK_MAX_RETRY_DELAY", "1800"))
+
+
+# Connexions SMTP : réglages (variables d'environnement)
+SMTP_HOST         = os.getenv("SMTP_HOST", "ssl0.ovh.net")
+SMTP_PORT         = int(os.getenv("SMTP_PORT", "587"))
+SMTP_POOL_SIZE    = int(os.getenv("SMTP_POOL_SIZE", str(DELIVERY_WORKERS)))
+SMTP_KEEPALIVE    = float(os.getenv("SMTP_KEEPALIVE", "60"))     # NOOP sur les sessions inactives depuis N s
+SMTP_IDLE_CLOSE   = float(os.getenv("SMTP_IDLE_CLOSE", "240"))   # fermeture au-delà (le serveur coupe vers 5 min)
+SMTP_MAX_MESSAGES = int(os.getenv("SMTP_MAX_MESSAGES", "100"))   # messages par session avant reconnexion
+
+
+def get_recipients(value=None):
+    """Destinataires : liste, ou chaîne séparée par des virgules / points-virgules (EMAIL_DEST par défaut)."""
+    if value is None:
+        value = os.getenv("EMAIL_DEST", "")
+    if isinstance(value, str):
+        value = value.replace(";", ",").split(",")
+    return [r.strip() for r in value if r and r.strip()]
+
+
+class smtpsession:
+    """Une connexion SMTP authentifiée (STARTTLS + login), rouverte à la demande."""
+    def __init__(self, host, port, user, password):
+        self.host, self.port, self.user, self.password = host, port, user, password
+        self.server = None
+        self.last_used = 0.0
+        self.messages = 0
+        self.connections = 0
+
+    def connect(self):
+        self.close()
+        server = smtplib.SMTP(self.host, self.port, timeout=30)
+        server.starttls()
+        server.login(self.user, self.password)
+        self.server, self.messages, self.last_used = server, 0, time.time()
+        self.connections += 1
+
+    def close(self):
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except Exception:
+                pass
+            self.server = None
+
+    def alive(self):
+        if self.server is None:
+            return False
+        try:
+            return self.server.noop()[0] == 250
+        except Exception:
+            return False
+
+    def ensure(self):
+        # Session neuve si absente, trop utilisée ou muette au NOOP après une période d'inactivité
+        if (self.server is None or self.messages >= SMTP_MAX_MESSAGES
+                or (time.time() - self.last_used > SMTP_KEEPALIVE and not self.alive())):
+            self.connect()
+
+    def send(self, msg, recipient):
+        """Envoie msg à un seul destinataire (enveloppe propre) ; une reconnexion si la session est tombée."""
+        for attempt in range(2):
+            self.ensure()
+            try:
+                self.server.send_message(msg, self.user, [recipient])
+                self.messages += 1
+                self.last_used = time.time()
+                return
+            except (smtplib.SMTPServerDisconnected, ConnectionError, TimeoutError):
+                self.close()
+                if attempt:
+                    raise
+
+
+class smtppool:
+    """Réserve de sessions SMTP authentifiées partagées par les threads d'envoi.
+
+    Un envoi emprunte une session (acquire), l'utilise pour tous ses destinataires puis la
+    rend : une campagne coûte quelques poignées de main TLS au lieu d'une par message.
+    Un thread de maintien envoie NOOP aux sessions inactives et ferme celles qui le sont
+    depuis plus de SMTP_IDLE_CLOSE secondes.
+    """
+    def __init__(self, size=SMTP_POOL_SIZE, host=SMTP_HOST, port=SMTP_PORT):
+        self.size, self.host, self.port = size, host, port
+        self.idle = queue.LifoQueue()
+        self.created = 0
+        self._lock = threading.Lock()
+        self._keepalive = None
+
+    def _new_session(self):
+        return smtpsession(self.host, self.port, os.getenv("EMAIL_USER"), os.getenv("EMAIL_PASS"))
+
+    def acquire(self, timeout=60):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self.created < self.size:
+                self.created += 1
+                if self._keepalive is None:
+                    self._keepalive = threading.Thread(target=self._keepalive_loop, name="smtp-keepalive", daemon=True)
+                    self._keepalive.start()
+                return self._new_session()
+        return self.idle.get(timeout=timeout)
+
+    def release(self, session):
+        self.idle.put(session)
+
+    def _keepalive_loop(self):
+        while True:
+            time.sleep(SMTP_KEEPALIVE)
+            checked = []
+            while True:
+                try:
+                    session = self.idle.get_nowait()
+                except queue.Empty:
+                    break
+                idle = time.time() - session.last_used
+                if session.server is not None and idle > SMTP_IDLE_CLOSE:
+                    session.close()
+                elif session.server is not None and idle > SMTP_KEEPALIVE and not session.alive():
+                    session.close()
+                checked.append(session)
+            for session in checked:
+                self.idle.put(session)
+
+    def send_batch(self, messages):
+        """Envoie [(destinataire, message)] sur une même session.
+
+        Retourne (failed, refused) : destinataires en échec temporaire, à retenter, et
+        destinataires refusés définitivement par le serveur (code 5xx), à ne pas retenter.
+        """
+        failed, refused = [], []
+        session = self.acquire()
+        try:
+            for recipient, msg in messages:
+                try:
+                    session.send(msg, recipient)
+                except smtplib.SMTPRecipientsRefused as e:
+                    print(f"Destinataire refusé {recipient} : {e}")
+                    codes = [code for code, _ in e.recipients.values()]
+                    (refused if codes and min(codes) >= 500 else failed).append(recipient)
+                except Exception as e:
+                    print(f"Erreur lors de l'envoi de l'e-mail à {recipient} : {e}")
+                    failed.append(recipient)
+        finally:
+            self.release(session)
+        return failed, refused
+
+
+smtp = smtppool()
+
+
+def build_message(subject, content, is_html, sender, recipient):
+    # Préparer le message en fonction du type de contenu
+    msg = MIMEText(content, 'html' if is_html else 'plain')
+    if is_html and "cid:" in content and IMAGE_PARTS:
+        # HTML + images intégrées (parties MIME communes à tous les messages)
+        related = MIMEMultipart('related')
+        related.attach(msg)
+        for part in IMAGE_PARTS:
+            related.attach(part)
+        msg = related
+    msg['Subject'] = subject
+    msg['From'] = sender
+    msg['To'] = recipient
+    return msg
+
+
+def send_batch(subject, content, is_html=False, recipients=None):
+    """Envoie un e-mail à chaque destinataire (une enveloppe par destinataire) via le pool SMTP.
+
+    Retourne (failed, refused) : destinataires en échec temporaire et destinataires refusés
+    définitivement (5xx) ; deux listes vides si tout est parti.
+    """
     sender_email = os.getenv("EMAIL_USER")
     sender_password = os.getenv("EMAIL_PASS")
-    recipient_email = os.getenv("EMAIL_DEST")
+    recipients = get_recipients(recipients)
 
     if not sender_email or not sender_password: 
         print("Erreur : Les variables d'environnement EMAIL_USER et EMAIL_PASS ne sont pas définies.")
-        return
+        return recipients, []
 
-    # Préparer le message en fonction du type de contenu
-    msg = MIMEText(content, 'html' if is_html else 'plain')
-    msg['Subject'] = subject
-    msg['From'] = sender_email
-    msg['To'] = recipient_email
+    # Un seul message construit, seul l'en-tête To change d'un destinataire à l'autre
+    msg = build_message(subject, content, is_html, sender_email, recipients[0] if recipients else "")
+    failed, refused = smtp.send_batch(_per_recipient(msg, recipients))
+    if len(failed) + len(refused) < len(recipients):
+        print(f"E-mail envoyé avec succès à {len(recipients) - len(failed) - len(refused)} destinataire(s) !")
+    return failed, refused
+
+
+def _per_recipient(msg, recipients):
+    # Générateur consommé par smtppool.send_batch dans le même thread : un envoi à la fois
+    for recipient in recipients:
+        msg.replace_header('To', recipient)
+        yield recipient, msg
+
+
+def send_email(subject, content, is_html=False, recipients=None):
+    failed, refused = send_batch(subject, content, is_html, recipients)
+    return not failed and not refused
+
+
+# Déduplication et limites de débit : réglages (variables d'environnement)
+DEDUP_TTL          = float(os.getenv("WEBHOOK_DEDUP_TTL", str(6 * 3600)))  # une alerte renvoyée dans ce délai est ignorée
+STATE_DB           = os.getenv("WEBHOOK_STATE_DB")                         # fichier SQLite partagé ; absent = mémoire
+RATE_GLOBAL        = float(os.getenv("WEBHOOK_RATE_GLOBAL", "60"))         # e-mails par minute, tous destinataires (0 = illimité)
+RATE_GLOBAL_BURST  = float(os.getenv("WEBHOOK_RATE_GLOBAL_BURST", "30"))
+RATE_RECIPIENT     = float(os.getenv("WEBHOOK_RATE_RECIPIENT", "10"))      # e-mails par minute et par destinataire (0 = illimité)
+RATE_RECIPIENT_BURST = float(os.getenv("WEBHOOK_RATE_RECIPIENT_BURST", "5"))
+
+
+class memorystate:
+    """État de déduplication, seaux à jetons et compteurs, en mémoire (un seul processus)."""
+    backend = "memory"
+
+    def __init__(self):
+        self.dedup = {}      # clé -> expiration
+        self.buckets = {}    # seau -> [jetons, dernière mise à jour]
+        self.counters = {}
+        self._lock = threading.Lock()
+        self._next_purge = 0.0
+
+    def check_and_mark(self, key, ttl, forget=()):
+        """True si key a déjà été vue il y a moins de ttl secondes ; sinon l'enregistre.
+
+        Les clés de forget sont effacées (ex. l'état "firing" quand l'alerte est résolue).
+        """
+        now = time.time()
+        with self._lock:
+            if now >= self._next_purge:   # éviction des entrées expirées, au plus une fois par minute
+                self.dedup = {k: exp for k, exp in self.dedup.items() if exp > now}
+                self._next_purge = now + 60
+            for k in forget:
+                self.dedup.pop(k, None)
+            if self.dedup.get(key, 0) > now:
+                return True
+            self.dedup[key] = now + ttl
+            return False
+
+    def forget(self, keys):
+        """Efface des clés de déduplication (notification finalement non mise en file)."""
+        with self._lock:
+            for k in keys:
+                self.dedup.pop(k, None)
+
+    def take(self, limits):
+        """Prend un jeton dans chaque seau de limits [(seau, rate par minute, burst)], tous ou aucun.
+
+        Retourne 0 si les jetons sont pris, sinon l'attente en secondes avant qu'ils le soient
+        tous ; aucun seau n'est alors débité.
+        """
+        now = time.time()
+        with self._lock:
+            levels = [(bucket, min(burst, tokens + (now - updated) * rate / 60), rate)
+                      for bucket, rate, burst in limits
+                      for tokens, updated in [self.buckets.get(bucket, (burst, now))]]
+            wait = _bucket_wait(levels)
+            for bucket, tokens, _ in levels:
+                self.buckets[bucket] = [tokens - 1 if not wait else tokens, now]
+            return wait
+
+    def incr(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def snapshot(self):
+        with self._lock:
+            now = time.time()
+            return dict(self.counters), sum(1 for exp in self.dedup.values() if exp > now)
+
+
+class sqlitestate(memorystate):
+    """Même état dans un fichier SQLite : conservé au redémarrage et partagé entre processus gunicorn."""
+    backend = "sqlite"
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._next_purge = 0.0
+        self._connection().executescript("""
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS dedup   (key TEXT PRIMARY KEY, expires REAL);
+            CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, tokens REAL, updated REAL);
+            CREATE TABLE IF NOT EXISTS counters(name TEXT PRIMARY KEY, value INTEGER);
+        """)
+
+    def _connection(self):
+        # Une connexion par thread
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = self._local.db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        return db
+
+    def _db(self):
+        # "with self._db() as db" : transaction BEGIN IMMEDIATE (verrou d'écriture entre processus)
+        return _sqlitetransaction(self._connection())
+
+    def check_and_mark(self, key, ttl, forget=()):
+        now = time.time()
+        with self._db() as db:
+            if now >= self._next_purge:
+                db.execute("DELETE FROM dedup WHERE expires <= ?", (now,))
+                self._next_purge = now + 60
+            db.executemany("DELETE FROM dedup WHERE key = ?", [(k,) for k in forget])
+            row = db.execute("SELECT expires FROM dedup WHERE key = ?", (key,)).fetchone()
+            if row is not None and row[0] > now:
+                return True
+            db.execute("INSERT OR REPLACE INTO dedup VALUES (?, ?)", (key, now + ttl))
+            return False
+
+    def forget(self, keys):
+        with self._db() as db:
+            db.executemany("DELETE FROM dedup WHERE key = ?", [(k,) for k in keys])
+
+    def take(self, limits):
+        now = time.time()
+        with self._db() as db:
+            levels = []
+            for bucket, rate, burst in limits:
+                row = db.execute("SELECT tokens, updated FROM buckets WHERE name = ?", (bucket,)).fetchone()
+                tokens, updated = row if row is not None else (burst, now)
+                levels.append((bucket, min(burst, tokens + (now - updated) * rate / 60), rate))
+            wait = _bucket_wait(levels)
+            db.executemany("INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)",
+                           [(bucket, tokens - 1 if not wait else tokens, now) for bucket, tokens, _ in levels])
+            return wait
+
+    def incr(self, name, n=1):
+        with self._db() as db:
+            db.execute("INSERT INTO counters VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + ?", (name, n, n))
+
+    def snapshot(self):
+        with self._db() as db:
+            counters = dict(db.execute("SELECT name, value FROM counters").fetchall())
+            active = db.execute("SELECT COUNT(*) FROM dedup WHERE expires > ?", (time.time(),)).fetchone()[0]
+        return counters, active
+
+
+def _bucket_wait(levels):
+    # Attente (s) jusqu'à ce que chaque seau [(seau, jetons, rate)] ait au moins un jeton
+    return max([(1 - tokens) * 60 / rate for _, tokens, rate in levels if tokens < 1], default=0.0)
+
+
+class _sqlitetransaction:
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute("BEGIN IMMEDIATE")
+        return self.db
+
+    def __exit__(self, exc_type, exc, tb):
+        self.db.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False
 
+
+state = sqlitestate(STATE_DB) if STATE_DB else memorystate()
+
+
+def rate_limit_wait(recipient):
+    """0 si un e-mail peut partir maintenant vers recipient, sinon l'attente (s) imposée par les seaux à jetons.
+
+    Les seaux du destinataire et global sont débités ensemble ou pas du tout.
+    """
+    limits = []
+    if RATE_RECIPIENT > 0:
+        limits.append((f"rcpt:{recipient.lower()}", RATE_RECIPIENT, RATE_RECIPIENT_BURST))
+    if RATE_GLOBAL > 0:
+        limits.append(("global", RATE_GLOBAL, RATE_GLOBAL_BURST))
+    return state.take(limits) if limits else 0.0
+
+
+class deliveryqueue:
+    """File d'envoi asynchrone des e-mails.
+
+    submit() écrit le message dans le spool (un fichier JSON par message) puis le place
+    dans une file bornée ; des threads d'envoi le remettent via send_batch (pool SMTP). Un
+    échec est retenté, pour les seuls destinataires concernés, avec un délai doublé à
+    chaque tentative ; après max_attempts le fichier part dans spool/failed. Les
+    destinataires sans jeton de débit (voir RATE_*) sont reportés sans compter d'échec.
+    Au démarrage (et dans chaque processus issu d'un fork), les messages restés dans le
+    spool sont repris.
+    Avant l'envoi, chaque fichier est réservé par renommage atomique (.sending) : plusieurs
+    processus gunicorn partageant le même spool n'envoient pas deux fois le même message.
+    """
+    def __init__(self, spool_dir=SPOOL_DIR, maxsize=QUEUE_SIZE, workers=DELIVERY_WORKERS,
+                 max_attempts=MAX_ATTEMPTS, retry_delay=RETRY_DELAY, max_retry_delay=MAX_RETRY_DELAY):
+        self.spool_dir       = spool_dir
+        self.failed_dir      = os.path.join(spool_dir, "failed")
+        self.queue           = queue.Queue(maxsize=maxsize)
+        self.workers         = workers
+        self.max_attempts    = max_attempts
+        self.retry_delay     = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.sent = self.failed = 0
+        self._pid = None   # processus dont les threads d'envoi tournent
+        self._lock = threading.Lock()
+
+    def start(self):
+        pid = os.getpid()
+        with self._lock:
+            if self._pid == pid:
+                return self
+            if self._pid is not None:
+                # Processus fils (gunicorn --preload) : les threads du parent n'ont pas survécu
+                # au fork ; la file en mémoire est recréée, le spool est repris ci-dessous
+                self.queue = queue.Queue(maxsize=self.queue.maxsize)
+            self._pid = pid
+        os.makedirs(self.failed_dir, exist_ok=True)
+        for i in range(self.workers):
+            threading.Thread(target=self._worker, name=f"smtp-{i}", daemon=True).start()
+        pending = self._pending()   # listé avant toute nouvelle soumission
+        threading.Thread(target=self._recover, args=(pending,), name="spool-recover", daemon=True).start()
+        return self
+
+    def submit(self, subject, content, is_html=False, recipients=None):
+        """Met un e-mail en attente d'envoi ; lève queue.Full si la file est pleine."""
+        self.start()
+        if self.queue.full():
+            raise queue.Full
+        job = {"id": f"{time.time():.6f}-{uuid.uuid4().hex}", "subject": subject, "content": content,
+               "is_html": is_html, "recipients": get_recipients(recipients), "attempts": 0, "next_try": 0}
+        self._write(job)
+        try:
+            self.queue.put_nowait(job["id"])
+        except queue.Full:
+            os.remove(self._path(job["id"]))
+            raise
+        return job["id"]
+
+    def _path(self, job_id, suffix=".json"):
+        return os.path.join(self.spool_dir, job_id + suffix)
+
+    def _write(self, job, suffix=".json"):
+        tmp = self._path(job["id"], ".tmp")
+        with open(tmp, "w") as f:
+            json.dump(job, f)
+        os.replace(tmp, self._path(job["id"], suffix))
+
+    def _pending(self):
+        # Messages en attente d'un précédent démarrage, et réservations abandonnées (> 10 min)
+        pending = []
+        for name in sorted(os.listdir(self.spool_dir)):
+            path = os.path.join(self.spool_dir, name)
+            if name.endswith(".sending") and time.time() - os.path.getmtime(path) > 600:
+                try:
+                    os.replace(path, path[:-len(".sending")] + ".json")
+                except FileNotFoundError:
+                    continue
+                name = name[:-len(".sending")] + ".json"
+            if name.endswith(".json"):
+                pending.append(name[:-len(".json")])
+        return pending
+
+    def _recover(self, pending):
+        for job_id in pending:
+            self.queue.put(job_id)
+        if pending:
+            print(f"Spool repris : {len(pending)} e-mail(s) en attente")
+
+    def _retry_later(self, job_id, delay):
+        timer = threading.Timer(delay, self.queue.put, (job_id,))
+        timer.daemon = True
+        timer.start()
+
+    def _worker(self):
+        while True:
+            job_id = self.queue.get()
+            try:
+                self._deliver(job_id)
+            except Exception as e:
+                print(f"Erreur dans la file d'envoi ({job_id}) : {e}")
+            finally:
+                self.queue.task_done()
+
+    def _deliver(self, job_id):
+        sending = self._path(job_id, ".sending")
+        try:
+            os.replace(self._path(job_id), sending)   # réservation : un seul envoi par message
+        except FileNotFoundError:
+            return
+        os.utime(sending)   # date de réservation : os.replace garde celle de la dernière écriture (voir _pending)
+        try:
+            self._process(job_id, sending)
+        except Exception:
+            # Erreur imprévue (pool SMTP saturé, base SQLite verrouillée...) : le message
+            # retourne dans le spool et sera retenté, au lieu de rester orphelin en .sending
+            if os.path.exists(sending):
+                os.replace(sending, self._path(job_id))
+                self._retry_later(job_id, self.retry_delay)
+            raise
+
+    def _process(self, job_id, sending):
+        with open(sending) as f:
+            job = json.load(f)
+        wait = job["next_try"] - time.time()
+        if wait > 0:
+            os.replace(sending, self._path(job_id))
+            self._retry_later(job_id, wait)
+            return
+
+        # Limites de débit : les destinataires sans jeton sont reportés, sans compter d'échec
+        ready, deferred, rate_wait = [], [], 0.0
+        for recipient in get_recipients(job.get("recipients")):
+            wait = rate_limit_wait(recipient)
+            if wait:
+                deferred.append(recipient)
+                rate_wait = max(rate_wait, wait)
+            else:
+                ready.append(recipient)
+        if deferred:
+            state.incr("rate_limited", len(deferred))
+
+        failed, refused = send_batch(job["subject"], job["content"], job["is_html"], ready) if ready else ([], [])
+        state.incr("emails_sent", len(ready) - len(failed) - len(refused))
+        if refused:
+            # Refus définitif (5xx) : pas de nouvel essai, une trace dans spool/failed
+            # (complétée si une tentative suivante du même message est aussi refusée)
+            path = os.path.join(self.failed_dir, job_id + "-refused.json")
+            if os.path.exists(path):
+                with open(path) as f:
+                    refused = json.load(f)["recipients"] + refused
+            with open(path, "w") as f:
+                json.dump(dict(job, recipients=refused), f)
+            state.incr("emails_failed", len(refused))
+            print(f"E-mail {job_id} refusé définitivement pour {', '.join(refused)}")
+        if not failed and not deferred:
+            os.remove(sending)
+            self.sent += 1
+            return
+
+        job["recipients"] = failed + deferred   # seuls les destinataires en échec ou reportés sont retentés
+        if failed:
+            job["attempts"] += 1
+        if job["attempts"] >= self.max_attempts:
+            os.replace(sending, os.path.join(self.failed_dir, job_id + ".json"))
+            self.failed += 1
+            state.incr("emails_failed", len(failed))
+            print(f"Abandon de l'e-mail {job_id} après {job['attempts']} tentatives")
+            return
+        delay = min(self.retry_delay * 2 ** (job["attempts"] - 1), self.max_retry_delay) if failed else rate_wait
+        job["next_try"] = time.time() + delay
+        self._write(job)
+        os.remove(sending)
+        print(f"Nouvel essai de l'e-mail {job_id} dans {delay:.0f} s")
+        self._retry_later(job_id, delay)
+
+
+# Démarrée dès l'import : le spool laissé par un arrêt précédent part sans attendre la
+# prochaine alerte. Sous gunicorn, chaque worker importe le module (sans --preload) et
+# démarre donc ses propres threads ; avec --preload, start() les relance dans chaque
+# worker (voir _pid) et la réservation par renommage évite les doublons.
+delivery = deliveryqueue().start()
+
+
+# Regroupement des alertes et résumés (digest)
+DIGEST_WINDOW = float(os.getenv("WEBHOOK_DIGEST_WINDOW", "0"))   # secondes ; 0 = un e-mail par groupe, sans attendre
+
+# Listes personnalisées pour les jours et mois en français
+DAYS_FR = ["Lundi", "Mardi", "Mercredi", "Jeudi", "Vendredi", "Samedi", "Dimanche"]
+MONTHS_FR = ["Janvier", "Février", "Mars", "Avril", "Mai", "Juin", "Juillet", "Août", "Septembre", "Octobre", "Novembre", "Décembre"]
+
+
+# Fonction de formatage de la date (les mêmes dates reviennent d'une notification à l'autre)
+@functools.lru_cache(maxsize=4096)
+def format_time(iso_time):
+    if not iso_time:
+        return "Unknown time"
     try:
-        with smtplib.SMTP('ssl0.ovh.net', 587) as server:
-            server.starttls()
-            server.login(sender_email, sender_password)
-            server.send_message(msg)
-            print("E-mail envoyé avec succès !")
-    except Exception as e:
-        print(f"Erreur lors de l'envoi de l'e-mail : {e}")
+        # Vérifier et normaliser les millisecondes
+        if "." in iso_time:
+            base_time, milliseconds = iso_time.split(".")
+            milliseconds = milliseconds.rstrip("Z")  # Supprimer le 'Z' à la fin
+            milliseconds = milliseconds[:6]  # Limiter à 6 chiffres
+            iso_time = f"{base_time}.{milliseconds}Z"
+
+        # Conversion de la chaîne de date en objet datetime
+        date_obj = datetime.strptime(iso_time, "%Y-%m-%dT%H:%M:%S.%fZ" if "." in iso_time else "%Y-%m-%dT%H:%M:%SZ")
+
+        # Extraire les composants de la date
+        day_name = DAYS_FR[date_obj.weekday()]  # Nom du jour
+        day = date_obj.day  # Jour du mois
+        month_name = MONTHS_FR[date_obj.month - 1]  # Nom du mois
+        year = date_obj.year  # Année
+        hour = date_obj.strftime("%H")  # Heure
+        minute = date_obj.strftime("%M")  # Minute
+
+        # Retourner la date formatée
+        return f"{day_name} {day} {month_name} {year} à {hour}h{minute} (UTC)"
+
+    except ValueError:
+        return "Invalid time format"
+
+
+def alert_key(alert, default_status="unknown"):
+    """(alertname, status) d'une alerte Grafana ; le statut propre à l'alerte prime sur celui du message."""
+    return (alert.get("labels", {}).get("alertname", "No alert name"), alert.get("status", default_status))
+
+
+def alert_fingerprint(alert):
+    return alert.get("fingerprint") or json.dumps(alert.get("labels", {}), sort_keys=True)
+
+
+def is_duplicate(alert, status):
+    """Vrai si cette alerte a déjà été notifiée avec ce statut depuis moins de DEDUP_TTL secondes.
+
+    Un changement de statut efface l'état opposé : une alerte résolue puis de nouveau
+    déclenchée est bien notifiée.
+    """
+    fingerprint = alert_fingerprint(alert)
+    other = {"firing": "resolved", "resolved": "firing"}.get(status)
+    return state.check_and_mark(f"{fingerprint}|{status}", DEDUP_TTL,
+                                forget=(f"{fingerprint}|{other}",) if other else ())
+
+
+def release_alerts(groups):
+    """Annule la déduplication des alertes de groups : elles n'ont pas pu être mises en file.
+
+    Un renvoi de Grafana (après un 503) sera ainsi bien notifié.
+    """
+    if DEDUP_TTL > 0:
+        state.forget([f"{alert_fingerprint(a)}|{status}" for (_, status), alerts in groups.items() for a in alerts])
+
+
+def group_alerts(data):
+    """Toutes les alertes du message, regroupées par (alertname, status) dans l'ordre d'arrivée."""
+    groups = {}
+    for alert in data.get("alerts") or []:
+        key = alert_key(alert, data.get("status", "unknown"))
+        state.incr("alerts_received")
+        if DEDUP_TTL > 0 and is_duplicate(alert, key[1]):
+            state.incr(f"suppressed_{key[1]}")   # renvoi Grafana (repeat interval) déjà notifié
+            continue
+        groups.setdefault(key, []).append(alert)
+    return groups
+
+
+def render_alert(alert, status):
+    """Bloc HTML (dates + message) d'une alerte, mémorisé par (alerte, statut)."""
+    key = (alert_fingerprint(alert), status, alert.get("startsAt"), alert.get("endsAt"),
+           json.dumps(alert.get("annotations", {}), sort_keys=True))
+    with _fragment_lock:
+        fragment = _fragment_cache.get(key)
+        if fragment is not None:
+            _fragment_cache.move_to_end(key)
+            return fragment
+
+    # Déterminer le message à afficher
+    if status == "firing":
+        starts_at = format_time(alert.get("startsAt", ""))
+        ends_at = "En cours"
+        message = alert.get("annotations", {}).get("summary", "No description")
+    elif status == "resolved":
+        # Assurer que les heures sont distinctes et correctes
+        starts_at = format_time(alert.get("startsAt", ""))
+        ends_at = format_time(alert.get("endsAt", ""))
+        message = alert.get("annotations", {}).get("description", "No description")
+    else:
+        starts_at = "Inconnu"
+        ends_at = "Inconnu"
+        message = "Aucune donnée disponible."
+    fragment = ALERT_TEMPLATE.render(starts_at=starts_at, ends_at=ends_at, message=message)
+
+    with _fragment_lock:
+        _fragment_cache[key] = fragment
+        if len(_fragment_cache) > FRAGMENT_CACHE_SIZE:
+            _fragment_cache.popitem(last=False)
+    return fragment
+
+
+def group_subject(alert_name, status, count=1):
+    suffix = f" ({count} alertes)" if count > 1 else ""
+    if status == "firing":
+        return f"{alert_name} en cours{suffix} - COMEA alerte"
+    if status == "resolved":
+        return f"[Fin d'événement] {alert_name}{suffix} - COMEA alerte"
+    return "Ce mail est un bug - COMEA alerte"
+
+
+def render_group(alert_name, status, alerts):
+    return GROUP_TEMPLATE.render(alert_name=alert_name, fragments=[render_alert(a, status) for a in alerts])
+
+
+def render_email(sections):
+    """Corps HTML complet autour des sections (une par groupe d'alertes)."""
+    return EMAIL_TEMPLATE.render(sections=sections, images=IMAGE_SRC)
+
+
+def build_emails(groups):
+    """[(sujet, corps)] : un e-mail par groupe (alertname, status)."""
+    return [(group_subject(name, status, len(alerts)), render_email([render_group(name, status, alerts)]))
+            for (name, status), alerts in groups.items()]
+
+
+def build_digest(groups):
+    """Un seul e-mail résumant tous les groupes reçus pendant la fenêtre de regroupement."""
+    if len(groups) == 1:
+        return build_emails(groups)[0]
+    n_alerts = sum(len(alerts) for alerts in groups.values())
+    firing = sorted({name for (name, status) in groups if status == "firing"})
+    subject = f"Résumé : {n_alerts} alertes" + (f", en cours : {', '.join(firing)}" if firing else "") + " - COMEA alerte"
+    sections = [render_group(f"{name} — {'en cours' if status == 'firing' else 'terminée' if status == 'resolved' else status}",
+                             status, alerts)
+                for (name, status), alerts in groups.items()]
+    return subject, render_email(sections)
+
+
+class digestbuffer:
+    """Accumule les alertes pendant window secondes puis envoie un seul e-mail de résumé.
+
+    La fenêtre démarre à la première alerte reçue ; une même alerte (fingerprint) renvoyée
+    pendant la fenêtre remplace la précédente. Le tampon est en mémoire : les alertes
+    d'une fenêtre en cours sont perdues si le service s'arrête avant sa fin.
+    """
+    def __init__(self, window, submit):
+        self.window = window
+        self.submit = submit
+        self.groups = {}
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def add(self, groups):
+        with self._lock:
+            for key, alerts in groups.items():
+                group = self.groups.setdefault(key, {})
+                for alert in alerts:
+                    group[alert_fingerprint(alert)] = alert
+            if self._timer is None:
+                self._timer = threading.Timer(self.window, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        with self._lock:
+            groups = {key: list(alerts.values()) for key, alerts in self.groups.items()}
+            self.groups, self._timer = {}, None
+        if groups:
+            subject, body = build_digest(groups)
+            try:
+                self.submit(subject, body, is_html=True)
+            except queue.Full:
+                release_alerts(groups)
+                print(f"File d'envoi pleine : résumé perdu ({subject}), alertes renotifiées au prochain envoi de Grafana")
+
+
+digest = digestbuffer(DIGEST_WINDOW, delivery.submit) if DIGEST_WINDOW > 0 else None
 
 
 # Route pour gérer le webhook
@@ -39,165 +816,45 @@ def grafana_webhook():
     data = request.json
     print("Données reçues :", data)
     if data:
-        # Récupérer les informations nécessaires
-        status = data.get("status", "unknown")  # "firing" ou "resolved"
-        alert = data.get("alerts", [{}])[0]  # Premier élément de la liste d'alertes
-        alert_name = alert.get("labels", {}).get("alertname", "No alert name")
-        message1 = alert.get("annotations", {}).get("summary", "No description")
-        message2 = alert.get("annotations", {}).get("description", "No description")
-
-        
-        # Fonction de formatage de la date
-        def format_time(iso_time):
-            if not iso_time:
-                return "Unknown time"
-            try:
-                # Vérifier et normaliser les millisecondes
-                if "." in iso_time:
-                    base_time, milliseconds = iso_time.split(".")
-                    milliseconds = milliseconds.rstrip("Z")  # Supprimer le 'Z' à la fin
-                    milliseconds = milliseconds[:6]  # Limiter à 6 chiffres
-                    iso_time = f"{base_time}.{milliseconds}Z"
-                
-                # Conversion de la chaîne de date en objet datetime
-                date_obj = datetime.strptime(iso_time, "%Y-%m-%dT%H:%M:%S.%fZ" if "." in iso_time else "%Y-%m-%dT%H:%M:%SZ")
-                
-                # Listes personnalisées pour les jours et mois en français
-                days = ["Lundi", "Mardi", "Mercredi", "Jeudi", "Vendredi", "Samedi", "Dimanche"]
-                months = ["Janvier", "Février", "Mars", "Avril", "Mai", "Juin", "Juillet", "Août", "Septembre", "Octobre", "Novembre", "Décembre"]
-                
-                # Extraire les composants de la date
-                day_name = days[date_obj.weekday()]  # Nom du jour
-                day = date_obj.day  # Jour du mois
-                month_name = months[date_obj.month - 1]  # Nom du mois
-                year = date_obj.year  # Année
-                hour = date_obj.strftime("%H")  # Heure
-                minute = date_obj.strftime("%M")  # Minute
-                
-                # Retourner la date formatée
-                return f"{day_name} {day} {month_name} {year} à {hour}h{minute} (UTC)"
-            
-            except ValueError:
-                return "Invalid time format"
-
-        
-        # Déterminer le message à afficher
-        if status == "firing":
-            starts_at = format_time(alert.get("startsAt", ""))
-            ends_at = "En cours"
-            subject = f"{alert_name} en cours - COMEA alerte"
-            message = f"{message1}"
-        elif status == "resolved":
-            # Assurer que les heures sont distinctes et correctes
-            starts_at = format_time(alert.get("startsAt", ""))
-            ends_at = format_time(alert.get("endsAt", ""))
-            subject = f"[Fin d'événement] {alert_name} - COMEA alerte"
-            message = f"{message2}"
-        else:
-            starts_at = "Inconnu"
-            ends_at = "Inconnu"
-            subject = "Ce mail est un bug - COMEA alerte"
-            message = "Aucune donnée disponible."
-
-        print(f"StartsAt formaté : {starts_at}")
-        print(f"EndsAt formaté : {ends_at}")
-
-        # Construire le sujet et le corps de l'e-mail
-        body = f"""
-                <html>
-                <head>
-                    <style>
-                        body {{
-                            font-family: Arial, sans-serif;
-                            color: #333;
-                            background-color: #f9f9f9;
-                            margin: 0;
-                            padding: 20px;
-                        }}
-                        .container {{
-                            background: white;
-                            border-radius: 8px;
-                            box-shadow: 0 2px 4px rgba(0, 0, 0, 0.1);
-                            padding: 20px;
-                            max-width: 600px;
-                            margin: auto;
-                        }}
-                        .title {{
-                            font-size: 24px;
-                            font-weight: bold;
-                            text-align: center;
-                            margin-bottom: 20px;
-                        }}
-                        .times {{
-                            text-align: left;
-                            font-size: 16px;
-                            margin-bottom: 20px;
-                        }}
-                        .separator {{
-                            border-top: 2px solid #ddd;
-                            margin: 20px 0;
-                        }}
-                        .message {{
-                            text-align: left;
-                            font-size: 16px;
-                            margin-bottom: 20px;
-                        }}
-                        .logo {{
-                            text-align: center;
-                            margin-top: 20px;
-                        }}
-                        .footer {{
-                            background-color: #f4f4f4;
-                            border-radius: 8px;
-                            padding: 5px;
-                            text-align: center;
-                            margin-top: 20px;
-                            font-size: 14px;
-                            color: #555;
-                            border: 1px solid #ddd;
-                        }}
-                        .logo img {{
-                            width: 150px;
-                            margin: 3px 0;
-                        }}
-                        .bandeau img {{
-                            width: 95%;
-                            height: auto;
-                        }}
-                    </style>
-                </head>
-                <body>
-                    <div class="container">
-                        <div class="title">{alert_name}</div>
-                        <div class="times">
-                            <strong>Début :</strong> {starts_at}<br>
-                            <strong>Fin :</strong> {ends_at}
-                        </div>
-                        <div class="separator"></div>
-                        <div class="message">{message}</div>
-                
-                        <!-- Encadré d'explication -->
-                        <div class="footer">
-                            <p><i>Ce service est fourni et opéré par le COMEA</strong></i>
-                            <div class="logo">
-                                <img src="https://raw.githubusercontent.com/AurorAlpes/COMEA/b50d6143240d132a583bc5a4a45221bf163a812e/logo%20comea.svg" alt="comea.space">
-                            </div>
-                            <div class="bandeau">
-                                <img src="https://raw.githubusercontent.com/AurorAlpes/COMEA/refs/heads/main/Design%20sans%20titre.png" alt="OFRAME, IRAP, CNRS, ONERA, CLS, CEA, THALES ">
-                            </div>
-                        </div>
-                    </div>
-                </body>
-                </html>
-                """
-
-        # Envoyer l'e-mail
-        send_email(subject, body, is_html=True)  # Indiquer que le contenu est HTML
-        return "Email sent", 200
+        # Toutes les alertes du message, regroupées par (alertname, status)
+        groups = group_alerts(data)
+        if not groups and data.get("alerts"):
+            return "All alerts already notified", 200
+        if not groups:
+            groups = {(data.get("commonLabels", {}).get("alertname", "No alert name"), data.get("status", "unknown")): [{}]}
+
+        if digest is not None:
+            digest.add(groups)
+            return f"{sum(len(a) for a in groups.values())} alert(s) buffered for digest", 202
+
+        # Mettre les e-mails en file d'envoi : la réponse part sans attendre le serveur SMTP
+        pending = dict(groups)
+        try:
+            for key, (subject, body) in zip(groups, build_emails(groups)):
+                delivery.submit(subject, body, is_html=True)  # Indiquer que le contenu est HTML
+                del pending[key]
+        except queue.Full:
+            release_alerts(pending)   # seuls les groupes non mis en file seront renotifiés
+            return "Email queue full", 503
+        return f"{len(groups)} email(s) queued", 202
 
     return "No data received", 400
 
 
+# Compteurs : alertes reçues, renvois supprimés (par statut), reports pour débit, e-mails envoyés...
+@app.route("/stats", methods=["GET"])
+def stats():
+    counters, dedup_entries = state.snapshot()
+    return jsonify({
+        "backend": state.backend,
+        "counters": counters,
+        "suppressed": sum(v for k, v in counters.items() if k.startswith("suppressed_")),
+        "dedup_entries": dedup_entries,
+        "queue_size": delivery.queue.qsize(),
+        "digest_pending": sum(len(a) for a in digest.groups.values()) if digest is not None else 0,
+    })
+
+
 
 # Point d'entrée de l'application
 if __name__ == '__main__':
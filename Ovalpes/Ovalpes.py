@@ -1,29 +1,271 @@
+import os
+import sys
+import argparse
+import cProfile
+import functools
+import hashlib
 import json
+import pickle
 import math
-import heapq
+import importlib
 import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
-from matplotlib import colors, cm
-from matplotlib.colors import Normalize
-from matplotlib.cm import ScalarMappable
-import cartopy.crs as ccrs
-import cartopy.feature as cfeature
-import aacgmv2
 import datetime
+import itertools
+import threading
+import time
+import warnings
+import tracemalloc
+import subprocess
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ProcessPoolExecutor
+
+# --- Imports paresseux et mode sans affichage ---
+class _lazymodule:
+    """Module importé seulement au premier accès à l'un de ses attributs.
+
+    pandas, matplotlib, Cartopy et aacgmv2 représentent l'essentiel du temps de démarrage :
+    une conversion ou un export d'associations n'importe ainsi que ce qu'il utilise.
+    """
+    def __init__(self, name, before_import=None):
+        self.__dict__.update(_name=name, _module=None, _before_import=before_import)
+
+    def _load(self):
+        module = self.__dict__["_module"]
+        if module is None:
+            if self._before_import is not None:
+                self._before_import()
+            module = self.__dict__["_module"] = importlib.import_module(self._name)
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        return f"<module {self._name!r} ({'chargé' if self.__dict__['_module'] else 'paresseux'})>"
+
+# Sans affichage (OVALPES_HEADLESS=1, ou Linux sans DISPLAY/WAYLAND_DISPLAY) : backend Agg
+# garanti et plt.show() remplacé par une simple fermeture des figures (voir _show)
+HEADLESS = (os.environ.get("OVALPES_HEADLESS", "") not in ("", "0")
+            or (sys.platform.startswith("linux") and not os.environ.get("DISPLAY") and not os.environ.get("WAYLAND_DISPLAY")))
+
+def _configure_backend():
+    if HEADLESS:
+        importlib.import_module("matplotlib").use("Agg")
+
+def set_headless(headless=True):
+    """Force (ou lève) le mode sans affichage, même si pyplot est déjà importé."""
+    global HEADLESS
+    HEADLESS = headless
+    if headless and "matplotlib" in sys.modules:
+        sys.modules["matplotlib"].use("Agg")
+
+def _show():
+    if HEADLESS:
+        plt.close()
+    else:
+        plt.show()
+
+pd         = _lazymodule("pandas")
+matplotlib = _lazymodule("matplotlib")
+plt        = _lazymodule("matplotlib.pyplot", before_import=_configure_backend)
+mdates     = _lazymodule("matplotlib.dates")
+colors     = _lazymodule("matplotlib.colors")
+cm         = _lazymodule("matplotlib.cm")
+backend_pdf = _lazymodule("matplotlib.backends.backend_pdf", before_import=_configure_backend)
+ccrs       = _lazymodule("cartopy.crs")
+cfeature   = _lazymodule("cartopy.feature")
+aacgmv2    = _lazymodule("aacgmv2")
+
+_ckdtree = False
+def _get_ckdtree():
+    # scipy est optionnel : None -> repli sur une recherche matricielle numpy
+    global _ckdtree
+    if _ckdtree is False:
+        try:
+            from scipy.spatial import cKDTree as _ckdtree
+        except ImportError:
+            _ckdtree = None
+    return _ckdtree
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache")
+
+
+QD_EPOCH  = datetime.datetime(2024, 5, 10)
+QD_HEIGHT = 110
+
+# --- Instrumentation (profilage à la demande) ---
+try:
+    import resource
+except ImportError:  # Windows : pas de getrusage, le pic mémoire est suivi par tracemalloc
+    resource = None
+
+class _nullstage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULLSTAGE = _nullstage()
+
+class _stagetimer:
+    __slots__ = ("profiler", "name", "start")
+
+    def __init__(self, profiler, name):
+        self.profiler, self.name = profiler, name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler._record(self.name, self.start, time.perf_counter() - self.start)
+        return False
+
+class profilerclass:
+    """Minuteries par étape et par image, compteurs (appels AACGM, images...) et pic mémoire.
+
+    Désactivé par défaut : stage() renvoie alors un contexte vide partagé et count() se
+    limite à un test, le surcoût est négligeable. enable() démarre la collecte (et
+    cProfile si demandé) ; report() résume, write_trace() exporte au format Chrome trace
+    (chrome://tracing, Perfetto) et write_pstats() les statistiques cProfile.
+    Les processus du pool (workers) ne sont pas instrumentés, seul le processus principal l'est.
+    """
+    def __init__(self):
+        self.enabled = False
+        self._reset()
+
+    def _reset(self, trace=False, memory=True):
+        self.timings     = {}   # étape -> [nombre, total (s), max (s)]
+        self.counters    = {}
+        self.events      = []
+        self.trace       = trace
+        self.memory      = memory
+        self.peak_memory = 0
+        self._profile    = None
+        self._tracemalloc = False
+        self._t0         = time.perf_counter()
+
+    def enable(self, trace=False, cprofile=False, memory=True):
+        self._reset(trace, memory)
+        if memory and resource is None:
+            tracemalloc.start()
+            self._tracemalloc = True
+        if cprofile:
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        self.enabled = True
+        return self
+
+    def disable(self):
+        if self._profile is not None:
+            self._profile.disable()
+        if self._tracemalloc:
+            self._sample_memory()
+            tracemalloc.stop()
+            self._tracemalloc = False
+        self.enabled = False
+
+    def stage(self, name):
+        """Contexte chronométrant une étape : with PROFILER.stage("nom"): ..."""
+        return _stagetimer(self, name) if self.enabled else _NULLSTAGE
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def _record(self, name, start, duration):
+        t = self.timings.setdefault(name, [0, 0.0, 0.0])
+        t[0] += 1
+        t[1] += duration
+        t[2] = max(t[2], duration)
+        if self.trace:
+            self.events.append({"name": name, "ph": "X", "ts": (start - self._t0) * 1e6, "dur": duration * 1e6,
+                                "pid": os.getpid(), "tid": threading.get_ident()})
+        if self.memory:
+            self._sample_memory()
+
+    def _sample_memory(self):
+        if self._tracemalloc:
+            peak = tracemalloc.get_traced_memory()[1]
+        elif resource is not None:
+            # ru_maxrss : kio sous Linux, octets sous macOS
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+        else:
+            return
+        self.peak_memory = max(self.peak_memory, peak)
+
+    def report(self):
+        """Résumé texte : étapes triées par temps total, compteurs et pic mémoire."""
+        elapsed = time.perf_counter() - self._t0
+        lines = [f"Profil Ovalpes ({elapsed:.2f} s écoulées)",
+                 f"{'étape':<32}{'appels':>8}{'total (s)':>12}{'moyenne (ms)':>14}{'max (ms)':>11}"]
+        for name, (n, total, peak) in sorted(self.timings.items(), key=lambda kv: -kv[1][1]):
+            lines.append(f"{name:<32}{n:>8}{total:>12.3f}{total / n * 1000:>14.2f}{peak * 1000:>11.2f}")
+        for name, n in sorted(self.counters.items()):
+            lines.append(f"{name:<32}{n:>8}")
+        if self.peak_memory:
+            lines.append(f"pic mémoire{' (tracemalloc)' if resource is None else ''} : {self.peak_memory / 2**20:.1f} Mio")
+        return "\n".join(lines)
+
+    def write_trace(self, out_file):
+        with open(out_file, 'w') as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+        print(out_file)
+
+    def write_pstats(self, out_file):
+        if self._profile is None:
+            raise RuntimeError("cProfile n'est pas actif : appeler enable(cprofile=True)")
+        self._profile.dump_stats(out_file)
+        print(out_file)
+
+PROFILER = profilerclass()
+
+def _profiled(name):
+    """Décorateur : chronomètre chaque appel sous le nom name quand PROFILER est actif."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not PROFILER.enabled:
+                return fn(*args, **kwargs)
+            with _stagetimer(PROFILER, name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
 
 
 class cameraclass:
-    def __init__(self, data):
+    def __init__(self, data, qdlat=None, qdlon=None, epoch=QD_EPOCH):
         self.name = data.get('name', None)
         self.lon  = float(data['lon'])
         self.lat  = float(data['lat'])
-        self.qdlat = get_qd_latitude(self.lat, self.lon, datetime.datetime(2024, 5, 10))
+        if qdlat is None:
+            qdlat, qdlon = get_qd_coords([self.lat], [self.lon], epoch)
+            qdlat, qdlon = qdlat[0], qdlon[0]
+        self.qdlat = float(qdlat)
+        self.qdlon = float(qdlon) if qdlon is not None else np.nan
+        self.epoch = epoch
         self.lumd = data['lumd'] 
         times = pd.to_datetime(list(self.lumd.keys()), format="%Y%m%dT%H%M")
         self.df = (pd.DataFrame({'lumd': list(self.lumd.values())}, index=times).sort_index())
 
+    @classmethod
+    def from_arrays(cls, name, lat, lon, times, values, qdlat, qdlon=np.nan, epoch=QD_EPOCH):
+        """Caméra construite directement depuis des colonnes (times : index trié), sans dict lumd brut."""
+        cam = cls.__new__(cls)
+        cam.name, cam.lat, cam.lon = name, float(lat), float(lon)
+        cam.qdlat, cam.qdlon, cam.epoch = float(qdlat), float(qdlon), epoch
+        cam.lumd = None
+        cam.df = pd.DataFrame({'lumd': values}, index=times, copy=False)
+        return cam
+
 class magnetometerclass:
     def __init__(self, data):
         self.lon    = float(data['lon'])
@@ -33,23 +275,432 @@ class magnetometerclass:
         times = pd.to_datetime(self.time, format="%Y%m%dT%H%M")
         self.df = (pd.DataFrame({'H': self.valeur}, index=times).sort_index())
 
-
-def load_fripon_data(input_file):
+    @classmethod
+    def from_arrays(cls, lat, lon, times, values):
+        """Magnétomètre construit directement depuis des colonnes (times : index trié), sans listes brutes."""
+        mag = cls.__new__(cls)
+        mag.lat, mag.lon = float(lat), float(lon)
+        mag.time = mag.valeur = None
+        mag.df = pd.DataFrame({'H': values}, index=times, copy=False)
+        return mag
+
+
+class _stationview:
+    """Vue d'une ligne de stationmatrixclass qui se comporte comme cameraclass/magnetometerclass."""
+    def __init__(self, matrix, i):
+        self._matrix, self._i = matrix, i
+        self.name  = matrix.names[i]
+        self.lat   = float(matrix.lat[i])
+        self.lon   = float(matrix.lon[i])
+        self.qdlat = float(matrix.qdlat[i])
+        self.qdlon = float(matrix.qdlon[i])
+        self._df = None
+
+    @property
+    def df(self):
+        if self._df is None:
+            m = self._matrix
+            row = m.mask[self._i]
+            self._df = pd.DataFrame({m.column: m.data[self._i, row]}, index=m.times[row])
+        return self._df
+
+class stationmatrixclass:
+    """Toutes les stations alignées sur un axe de temps commun.
+
+    data[i, j] est la valeur de la station names[i] à times[j] (NaN si absente),
+    mask[i, j] indique si elle a été mesurée. L'objet se manipule aussi comme le dict
+    Fripon/Magnetometre (items(), [name], ...) et peut donc remplacer ceux-ci dans
+    toutes les fonctions de tracé.
+    """
+    def __init__(self, names, lat, lon, qdlat, qdlon, times, data, mask, column):
+        self.names  = list(names)
+        self.lat    = np.asarray(lat, dtype=float)
+        self.lon    = np.asarray(lon, dtype=float)
+        self.qdlat  = np.asarray(qdlat, dtype=float)
+        self.qdlon  = np.asarray(qdlon, dtype=float)
+        self.times  = pd.DatetimeIndex(times)
+        self.data   = data
+        self.mask   = mask
+        self.column = column
+        self._pos   = {name: i for i, name in enumerate(self.names)}
+        self.baselines = {}  # cache de compute_baseline
+        self._prev  = None
+        self._next  = None
+
+    @classmethod
+    @_profiled("matrix.from_stations")
+    def from_stations(cls, stations, column):
+        names = list(stations)
+        idx = [stations[n].df.index.values.astype('datetime64[ns]') for n in names]
+        times = np.unique(np.concatenate(idx)) if idx else np.empty(0, 'datetime64[ns]')
+        data = np.full((len(names), len(times)), np.nan, dtype=np.float64)
+        mask = np.zeros((len(names), len(times)), dtype=bool)
+        for i, n in enumerate(names):
+            cols = np.searchsorted(times, idx[i])
+            data[i, cols] = stations[n].df[column].to_numpy(dtype=np.float64)
+            mask[i, cols] = True
+        mask &= np.isfinite(data)
+        return cls(names,
+                   [stations[n].lat for n in names], [stations[n].lon for n in names],
+                   [getattr(stations[n], 'qdlat', np.nan) for n in names],
+                   [getattr(stations[n], 'qdlon', np.nan) for n in names],
+                   times, data, mask, column)
+
+    # --- Interface dict, compatible avec Fripon / Magnetometre ---
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __contains__(self, name):
+        return name in self._pos
+
+    def __getitem__(self, name):
+        return _stationview(self, self._pos[name])
+
+    def keys(self):
+        return list(self.names)
+
+    def values(self):
+        return [_stationview(self, i) for i in range(len(self.names))]
+
+    def items(self):
+        return [(n, _stationview(self, i)) for i, n in enumerate(self.names)]
+
+    # --- Requêtes vectorisées sur toutes les stations ---
+    def to_dataframe(self):
+        """DataFrame large (temps × stations), NaN là où il n'y a pas de mesure."""
+        return pd.DataFrame(np.where(self.mask, self.data, np.nan).T, index=self.times, columns=self.names)
+
+    def window(self, x_min, x_max):
+        """Sous-matrice restreinte à x_min <= t <= x_max (mêmes bornes que df.loc[x_min:x_max])."""
+        j0 = self.times.searchsorted(pd.Timestamp(x_min), side='left')
+        j1 = self.times.searchsorted(pd.Timestamp(x_max), side='right')
+        return stationmatrixclass(self.names, self.lat, self.lon, self.qdlat, self.qdlon,
+                                  self.times[j0:j1], self.data[:, j0:j1], self.mask[:, j0:j1], self.column)
+
+    def _neighbours(self):
+        # Pour chaque (station, colonne) : dernier indice valide <= j et prochain indice valide >= j (-1 sinon)
+        if self._prev is None:
+            n_t = len(self.times)
+            cols = np.arange(n_t)
+            self._prev = np.maximum.accumulate(np.where(self.mask, cols, -1), axis=1)
+            nxt = np.minimum.accumulate(np.where(self.mask, cols, n_t)[:, ::-1], axis=1)[:, ::-1]
+            self._next = np.where(nxt == n_t, -1, nxt)
+        return self._prev, self._next
+
+    def _take(self, cols):
+        # cols : (n_stations, n) indices de colonnes, -1 = pas de valeur
+        if not len(self.times):
+            return np.full(cols.shape, np.nan)
+        rows = np.arange(len(self.names))[:, None]
+        out = self.data[rows, np.maximum(cols, 0)]
+        return np.where(cols >= 0, out, np.nan)
+
+    def _ffill_cols(self, t):
+        if not len(self.times):   # aucune mesure (fenêtre vide, store pas encore alimenté)
+            return np.full((len(self.names), len(t)), -1)
+        prev, _ = self._neighbours()
+        j = self.times.searchsorted(t, side='right') - 1
+        return np.where(j >= 0, prev[:, np.maximum(j, 0)], -1)
+
+    def _nearest_cols(self, t):
+        before = self._ffill_cols(t)
+        if not len(self.times):
+            return before
+        prev, nxt = self._neighbours()
+        k = self.times.searchsorted(t, side='left')
+        after = np.where(k < len(self.times), nxt[:, np.minimum(k, len(self.times) - 1)], -1)
+        ti = self.times.asi8
+        t_ns = np.asarray(pd.DatetimeIndex(np.atleast_1d(t)).as_unit(self.times.unit).asi8)
+        d_before = np.where(before >= 0, t_ns - ti[np.maximum(before, 0)], np.iinfo(np.int64).max)
+        d_after  = np.where(after  >= 0, ti[np.maximum(after, 0)] - t_ns, np.iinfo(np.int64).max)
+        return np.where(d_after <= d_before, after, before)
+
+    def ffill(self, t):
+        """Dernière valeur connue à l'instant t pour chaque station (NaN si aucune mesure avant t)."""
+        return self._take(self._ffill_cols(np.atleast_1d(pd.Timestamp(t))))[:, 0]
+
+    def nearest(self, t):
+        """Valeur mesurée la plus proche de t (avant ou après) pour chaque station."""
+        return self._take(self._nearest_cols(np.atleast_1d(pd.Timestamp(t))))[:, 0]
+
+    def snapshots(self, times, max_age=None):
+        """Matrice (n_frames, n_stations) des dernières valeurs connues à chaque instant de times.
+
+        max_age (minutes ou Timedelta) : une valeur plus ancienne que max_age est remplacée par NaN.
+        """
+        times = pd.DatetimeIndex(times)
+        cols = self._ffill_cols(times)                       # (n_stations, n_frames)
+        if max_age is not None and len(times) and len(self.times):
+            if not isinstance(max_age, pd.Timedelta):
+                max_age = pd.Timedelta(minutes=max_age)
+            age = times.as_unit(self.times.unit).asi8[None, :] - self.times.asi8[np.maximum(cols, 0)]
+            cols = np.where(age <= max_age.value // _unit_ns(self.times.unit), cols, -1)
+        return self._take(cols).T
+
+def _unit_ns(unit):
+    return {'s': 10**9, 'ms': 10**6, 'us': 10**3, 'ns': 1}[unit]
+
+def as_station_matrix(stations, column):
+    """stations tel quel si c'est déjà une stationmatrixclass, sinon la matrice alignée correspondante."""
+    if isinstance(stations, stationmatrixclass):
+        return stations
+    return stationmatrixclass.from_stations(stations, column)
+
+@_profiled("compute_snapshots")
+def compute_snapshots(Fripon, times, max_age=None):
+    """Valeurs des caméras (dernière mesure connue) pour toutes les images d'une animation d'un coup."""
+    matrix = as_station_matrix(Fripon, 'lumd')
+    return matrix, matrix.snapshots(times, max_age=max_age)
+
+# --- Luminosités de référence (baselines) et deltas ---
+BASELINE_METHODS = ("nearest", "mean", "median", "quiet")
+
+@_profiled("compute_baseline")
+def compute_baseline(Fripon, method="nearest", ref_time=None, ref_start=None, ref_end=None, nights=3, tod_bin="10min"):
+    """Luminosité de référence de toutes les caméras en une passe vectorisée.
+
+    method :
+      - "nearest" : mesure la plus proche de ref_time ;
+      - "mean" / "median" : moyenne / médiane des mesures entre ref_start et ref_end ;
+      - "quiet" : courbe de nuit calme glissante, médiane des `nights` nuits précédentes
+        au même instant de la nuit (une référence par caméra ET par instant). L'instant de
+        la nuit est arrondi à tod_bin : l'échantillonnage FRIPON dérive d'une nuit à l'autre.
+    Retourne un tableau (n_caméras,) ou (n_caméras, n_temps) pour "quiet" ; NaN si aucune
+    mesure de référence. Le résultat est mémorisé sur la stationmatrixclass.
+    """
+    if method not in BASELINE_METHODS:
+        raise ValueError(f"method doit être l'un de {BASELINE_METHODS}, pas {method!r}")
+    matrix = as_station_matrix(Fripon, 'lumd')
+    key = _baseline_key(method, ref_time, ref_start, ref_end, nights, tod_bin)
+    if key in matrix.baselines:
+        return matrix.baselines[key]
+
+    if method == "nearest":
+        if ref_time is None:
+            raise ValueError("method='nearest' demande ref_time")
+        ref = matrix.nearest(ref_time)
+    elif method in ("mean", "median"):
+        if ref_start is None or ref_end is None:
+            raise ValueError(f"method={method!r} demande ref_start et ref_end")
+        win = matrix.window(ref_start, ref_end)
+        vals = np.where(win.mask, win.data, np.nan)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning)  # caméras sans mesure -> NaN
+            ref = (np.nanmean if method == "mean" else np.nanmedian)(vals, axis=1) if vals.shape[1] else np.full(len(matrix), np.nan)
+    else:
+        ref = _quiet_night_baseline(matrix, nights, tod_bin)
+
+    matrix.baselines[key] = ref
+    return ref
+
+def _baseline_key(method, ref_time, ref_start, ref_end, nights, tod_bin="10min"):
+    return (method,
+            None if ref_time is None else pd.Timestamp(ref_time),
+            None if ref_start is None else pd.Timestamp(ref_start),
+            None if ref_end is None else pd.Timestamp(ref_end),
+            (nights, pd.Timedelta(tod_bin)) if method == "quiet" else None)
+
+def _quiet_night_baseline(matrix, nights, tod_bin="10min"):
+    # Une "nuit" commence à midi UTC : la nuit du 10 au 11 mai porte la date du 10
+    shifted = matrix.times - pd.Timedelta(hours=12)
+    night = shifted.normalize()
+    tod = (shifted - night).floor(tod_bin).asi8   # mêmes cases d'une nuit à l'autre malgré la dérive
+    night_values, night_idx = np.unique(night.asi8, return_inverse=True)
+    tod_values, tod_idx = np.unique(tod, return_inverse=True)
+
+    # Moyenne des mesures de chaque caméra par (nuit, case horaire)
+    total = np.zeros((len(matrix), len(night_values), len(tod_values)))
+    count = np.zeros_like(total)
+    np.add.at(total, (slice(None), night_idx, tod_idx), np.where(matrix.mask, matrix.data, 0.0))
+    np.add.at(count, (slice(None), night_idx, tod_idx), matrix.mask)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        cube = np.where(count > 0, total / count, np.nan)
+    # Nuits d-nights .. d-1 pour la nuit d (pas de référence pour les premières nuits)
+    padded = np.concatenate([np.full((len(matrix), nights, len(tod_values)), np.nan), cube], axis=1)
+    windows = np.lib.stride_tricks.sliding_window_view(padded, nights, axis=1)[:, :len(night_values)]
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        quiet = np.nanmedian(windows, axis=-1)                   # (n, n_nuits, n_instants)
+    return quiet[:, night_idx, tod_idx]
+
+@_profiled("compute_delta")
+def compute_delta(Fripon, method="nearest", ref_time=None, ref_start=None, ref_end=None, nights=3, tod_bin="10min"):
+    """Matrice des écarts à la référence, sous forme de stationmatrixclass (colonne 'delta_lumd').
+
+    Elle s'utilise comme la matrice des caméras : keogrammes, snapshots des cartes, exports.
+    """
+    matrix = as_station_matrix(Fripon, 'lumd')
+    ref = compute_baseline(matrix, method, ref_time, ref_start, ref_end, nights, tod_bin)
+    delta = matrix.data - (ref if ref.ndim == 2 else ref[:, None])
+    return stationmatrixclass(matrix.names, matrix.lat, matrix.lon, matrix.qdlat, matrix.qdlon,
+                              matrix.times, delta, matrix.mask & np.isfinite(delta), 'delta_lumd')
+
+def build_camera_matrix(Fripon):
+    return stationmatrixclass.from_stations(Fripon, 'lumd')
+
+def build_magneto_matrix(Magnetometre):
+    return stationmatrixclass.from_stations(Magnetometre, 'H')
+
+@_profiled("load_fripon_data")
+def load_fripon_data(input_file, epoch=QD_EPOCH, cache_dir=CACHE_DIR):
     with open(input_file, 'r') as f:
         raw = json.load(f)
-    return {name: cameraclass({**camdata, 'name': name}) for name, camdata in raw.items()}
+    # Conversion QD de toutes les caméras en un seul appel (et via le cache disque)
+    qdlat, qdlon = get_qd_coords([float(d['lat']) for d in raw.values()],
+                                 [float(d['lon']) for d in raw.values()], epoch, cache_dir=cache_dir)
+    return {name: cameraclass({**camdata, 'name': name}, qdlat=qa, qdlon=qo, epoch=epoch)
+            for (name, camdata), qa, qo in zip(raw.items(), qdlat, qdlon)}
 
+@_profiled("load_magneto_data")
 def load_magneto_data(input_file):
     with open(input_file, 'r') as f:
         raw = json.load(f)
     return {name: magnetometerclass(d) for name, d in raw.items()}
 
+# --- Format colonnaire ---
+# Un dossier de fichiers .npy non compressés (memory-mappables) :
+#   names, lat, lon           : une entrée par station
+#   offsets (int64, n+1)      : la station i occupe times/values[offsets[i]:offsets[i+1]]
+#   times   (int64)           : secondes depuis l'époque Unix, triées par station
+#   values  (float32)         : lumd (FRIPON) ou H (magnétomètres)
+#   meta.json                 : type de données et fichier source
+COLUMNAR_FILES = ("names", "lat", "lon", "offsets", "times", "values")
+
+@_profiled("convert_to_columnar")
+def convert_to_columnar(input_file, output_dir, kind):
+    """Conversion unique d'un JSON FRIPON (kind='fripon') ou magnétomètre (kind='magneto') en dossier colonnaire."""
+    if kind not in ("fripon", "magneto"):
+        raise ValueError(f"kind doit être 'fripon' ou 'magneto', pas {kind!r}")
+    with open(input_file, 'r') as f:
+        raw = json.load(f)
+
+    names, lats, lons, offsets, times, values = [], [], [], [0], [], []
+    for name, d in raw.items():
+        if kind == "fripon":
+            t_str, v = list(d['lumd'].keys()), list(d['lumd'].values())
+        else:
+            t_str, v = d['time'], d['valeur']
+        t = pd.to_datetime(t_str, format="%Y%m%dT%H%M").to_numpy().astype('datetime64[s]').astype(np.int64)
+        v = np.asarray(v, dtype=np.float32)
+        order = np.argsort(t, kind='stable')
+        names.append(name)
+        lats.append(float(d['lat']))
+        lons.append(float(d['lon']))
+        times.append(t[order])
+        values.append(v[order])
+        offsets.append(offsets[-1] + len(t))
+
+    os.makedirs(output_dir, exist_ok=True)
+    arrays = {
+        "names":   np.array(names, dtype=str),
+        "lat":     np.array(lats, dtype=np.float64),
+        "lon":     np.array(lons, dtype=np.float64),
+        "offsets": np.array(offsets, dtype=np.int64),
+        "times":   np.concatenate(times) if times else np.empty(0, np.int64),
+        "values":  np.concatenate(values) if values else np.empty(0, np.float32),
+    }
+    for key, arr in arrays.items():
+        np.save(os.path.join(output_dir, f"{key}.npy"), arr)
+    with open(os.path.join(output_dir, "meta.json"), 'w') as f:
+        json.dump({"kind": kind, "source": os.path.basename(input_file), "stations": len(names)}, f)
+    return output_dir
+
+def _read_columnar(input_dir, kind):
+    with open(os.path.join(input_dir, "meta.json"), 'r') as f:
+        meta = json.load(f)
+    if meta["kind"] != kind:
+        raise ValueError(f"{input_dir} contient des données {meta['kind']!r}, pas {kind!r}")
+    cols = {key: np.load(os.path.join(input_dir, f"{key}.npy"), mmap_mode='r') for key in COLUMNAR_FILES}
+    # Un seul DatetimeIndex pour toute l'archive, découpé ensuite par station
+    cols["index"] = pd.DatetimeIndex(np.asarray(cols["times"]).astype('datetime64[s]'))
+    return cols
+
+@_profiled("load_fripon_columnar")
+def load_fripon_columnar(input_dir, epoch=QD_EPOCH):
+    cols = _read_columnar(input_dir, "fripon")
+    off = cols["offsets"]
+    qdlat, qdlon = get_qd_coords(cols["lat"], cols["lon"], epoch)
+    return {str(name): cameraclass.from_arrays(str(name), cols["lat"][i], cols["lon"][i],
+                                               cols["index"][off[i]:off[i+1]], cols["values"][off[i]:off[i+1]],
+                                               qdlat[i], qdlon[i], epoch)
+            for i, name in enumerate(cols["names"])}
+
+@_profiled("load_magneto_columnar")
+def load_magneto_columnar(input_dir):
+    cols = _read_columnar(input_dir, "magneto")
+    off = cols["offsets"]
+    return {str(name): magnetometerclass.from_arrays(cols["lat"][i], cols["lon"][i],
+                                                     cols["index"][off[i]:off[i+1]], cols["values"][off[i]:off[i+1]])
+            for i, name in enumerate(cols["names"])}
+
 def get_qd_latitude(lat, lon, dtime=None, height=110):
     if dtime is None:
         dtime = datetime.datetime.utcnow()
+    PROFILER.count("aacgm.calls")
+    PROFILER.count("aacgm.points")
     qdlat, qdlon, _ = aacgmv2.get_aacgm_coord(lat, lon, height, dtime)
     return qdlat
 
+_qd_cache = {}  # un cache mémoire par cache_dir (None : mémoire seule)
+def _qd_cache_file(cache_dir):
+    return os.path.join(cache_dir, "qdcoords.json")
+
+def _qd_key(lat, lon, height, dtime):
+    return f"{lat:.6f},{lon:.6f},{float(height):g},{dtime:%Y%m%dT%H%M%S}"
+
+@_profiled("qd.get_qd_coords")
+def get_qd_coords(lats, lons, dtime, height=QD_HEIGHT, cache_dir=CACHE_DIR):
+    """Latitudes/longitudes QD d'un ensemble de stations, en un appel AACGM vectorisé.
+
+    Chaque résultat est mémorisé sur disque avec la clé (lat, lon, hauteur, époque) :
+    changer l'un de ces paramètres donne une autre clé, donc une nouvelle conversion.
+    Seules les stations absentes du cache sont converties.
+    """
+    lats = np.atleast_1d(np.asarray(lats, dtype=float))
+    lons = np.atleast_1d(np.asarray(lons, dtype=float))
+    cache = _qd_cache.get(cache_dir)
+    if cache is None:
+        cache = {}
+        if cache_dir is not None and os.path.exists(_qd_cache_file(cache_dir)):
+            with open(_qd_cache_file(cache_dir), 'r') as f:
+                cache = json.load(f)
+        _qd_cache[cache_dir] = cache
+
+    keys = [_qd_key(la, lo, height, dtime) for la, lo in zip(lats, lons)]
+    missing = [i for i, k in enumerate(keys) if k not in cache]
+    PROFILER.count("qd.cache_hits", len(keys) - len(missing))
+    if missing:
+        PROFILER.count("aacgm.calls")
+        PROFILER.count("aacgm.points", len(missing))
+        qdlat, qdlon, _ = aacgmv2.convert_latlon_arr(lats[missing], lons[missing], height, dtime)
+        for i, qa, qo in zip(missing, np.atleast_1d(qdlat), np.atleast_1d(qdlon)):
+            cache[keys[i]] = [float(qa), float(qo)]
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp = _qd_cache_file(cache_dir) + ".tmp"
+            with open(tmp, 'w') as f:
+                json.dump(cache, f)
+            os.replace(tmp, _qd_cache_file(cache_dir))
+
+    coords = np.array([cache[k] for k in keys], dtype=float).reshape(-1, 2)
+    return coords[:, 0], coords[:, 1]
+
+def set_qd_epoch(stations, epoch, height=QD_HEIGHT):
+    """Recalcule qdlat/qdlon de toutes les stations pour l'époque d'un autre événement."""
+    if isinstance(stations, stationmatrixclass):
+        # les _stationview sont recréées à chaque accès : on met à jour les colonnes de la matrice
+        stations.qdlat, stations.qdlon = get_qd_coords(stations.lat, stations.lon, epoch, height)
+        stations.epoch = epoch
+        return stations
+    names = list(stations)
+    qdlat, qdlon = get_qd_coords([stations[n].lat for n in names], [stations[n].lon for n in names], epoch, height)
+    for n, qa, qo in zip(names, qdlat, qdlon):
+        stations[n].qdlat, stations[n].qdlon, stations[n].epoch = float(qa), float(qo), epoch
+    return stations
+
 _cmap_cache = {}
 def get_red_green_cmap(lat_min, lat_max, lat_center=46.0):
     key = (lat_min, lat_max, lat_center)
@@ -65,11 +716,81 @@ def get_red_green_cmap(lat_min, lat_max, lat_center=46.0):
     _cmap_cache[key] = (cmap, norm)
     return cmap, norm
 
-def plot_all_cameras(Fripon, x_min, x_max, y_min, y_max, lat_transition=46):
+# --- Décimation des séries longues ---
+def _minmax_decimate(x, y, n_out):
+    # n_out/2 paquets consécutifs ; on garde le min et le max de chaque paquet, dans l'ordre du temps
+    n_buckets = max(1, n_out // 2)
+    size = math.ceil(len(y) / n_buckets)
+    pad = n_buckets * size - len(y)
+    yb = np.concatenate([y, np.full(pad, np.nan)]).reshape(n_buckets, size)
+    valid = np.isfinite(yb)
+    i_min = np.argmin(np.where(valid, yb, np.inf), axis=1)
+    i_max = np.argmax(np.where(valid, yb, -np.inf), axis=1)
+    keep = valid.any(axis=1)
+    base = np.arange(n_buckets)[keep] * size
+    idx = np.unique(np.concatenate([base + i_min[keep], base + i_max[keep]]))
+    return idx
+
+def _lttb_decimate(x, y, n_out):
+    # Largest-Triangle-Three-Buckets (Steinarsson 2013) : garde le point qui forme le plus
+    # grand triangle avec le point retenu précédent et la moyenne du paquet suivant
+    n = len(y)
+    if n_out < 3:
+        return np.array([0, n - 1])[:n_out]
+    edges = np.floor(np.linspace(1, n - 1, n_out - 1)).astype(int)
+    idx = np.empty(n_out, dtype=int)
+    idx[0], idx[-1] = 0, n - 1
+    a = 0
+    for b in range(n_out - 2):
+        lo, hi = edges[b], edges[b + 1]
+        nlo, nhi = edges[b + 1], (edges[b + 2] if b + 2 < len(edges) else n)
+        avg_x, avg_y = x[nlo:max(nhi, nlo + 1)].mean(), y[nlo:max(nhi, nlo + 1)].mean()
+        area = np.abs((x[a] - avg_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y - y[a]))
+        a = lo + int(np.argmax(area)) if hi > lo else a
+        idx[b + 1] = a
+    return np.unique(idx)
+
+def decimate_series(x, y, n_out, method="minmax"):
+    """Réduit une série à environ n_out points en préservant les pics (min/max par paquet ou LTTB).
+
+    x : DatetimeIndex ou tableau, y : valeurs. Retourne (x réduit, y réduit, nombre de points supprimés).
+    """
+    if method not in ("minmax", "lttb"):
+        raise ValueError(f"method doit être 'minmax' ou 'lttb', pas {method!r}")
+    y = np.asarray(y, dtype=float)
+    if n_out is None or len(y) <= n_out:
+        return x, y, 0
+    if method == "minmax":
+        idx = _minmax_decimate(x, y, n_out)
+    else:
+        xf = np.asarray(pd.DatetimeIndex(x).asi8 if isinstance(x, pd.DatetimeIndex) else x, dtype=float)
+        finite = np.flatnonzero(np.isfinite(y))
+        idx = finite[_lttb_decimate(xf[finite], y[finite], min(n_out, len(finite)))] if len(finite) else finite
+    return x[idx], y[idx], len(y) - len(idx)
+
+def _point_budget(ax, max_points, method, dpi=150):
+    """max_points="auto" : budget calé sur la largeur de l'axe en pixels à la résolution de sortie."""
+    if max_points != "auto":
+        return max_points
+    width_px = ax.get_position().width * ax.figure.get_figwidth() * dpi
+    return int(width_px * (2 if method == "minmax" else 1))
+
+def _decimated(ax, x, y, max_points, method, dpi=150):
+    if max_points is None:
+        return x, y, 0
+    return decimate_series(x, y, _point_budget(ax, max_points, method, dpi), method)
+
+def _report_decimation(removed, total):
+    if total:
+        print(f"Décimation : {removed} points supprimés sur {total} ({removed / total:.0%})")
+
+@_profiled("plot_all_cameras")
+def plot_all_cameras(Fripon, x_min, x_max, y_min, y_max, lat_transition=46, max_points=None, decimate="minmax", output_path=None):
     lat_min, lat_max = 42, 50
     cmap, norm = get_red_green_cmap(lat_min, lat_max, lat_transition)
     fig, ax = plt.subplots(figsize=(12, 6))
 
+    removed = total = 0
     for name, cam in Fripon.items():
         lat = cam.lat
         if not (lat_min <= lat <= lat_max):
@@ -77,10 +798,14 @@ def plot_all_cameras(Fripon, x_min, x_max, y_min, y_max, lat_transition=46):
         df = cam.df.loc[x_min:x_max]
         if df.empty:
             continue
-        ax.plot(df.index, df['lumd'],
+        x, y, n_removed = _decimated(ax, df.index, df['lumd'], max_points, decimate, dpi=fig.dpi)
+        removed, total = removed + n_removed, total + len(df)
+        ax.plot(x, y,
                 color=cmap(norm(lat)),
                 linewidth=2, alpha=0.3,
                 label=f"{name} ({lat:.1f}°N)")
+    if max_points is not None:
+        _report_decimation(removed, total)
     ax.set_xlabel("Time UTC")
     ax.xaxis.set_major_formatter(mdates.DateFormatter("%H:%M"))
     ax.tick_params(axis='x', rotation=30)
@@ -93,23 +818,105 @@ def plot_all_cameras(Fripon, x_min, x_max, y_min, y_max, lat_transition=46):
     cbar.set_label("Latitude (°N)")
     plt.title("Luminosity from FRIPON cameras by latitude (42°–50°N)")
     plt.tight_layout()
-    plt.show()
+    if output_path is not None:
+        out = os.path.join(output_path, "all_cameras.png")
+        with PROFILER.stage("savefig"):
+            plt.savefig(out, dpi=150)
+        print(out)
+    _show()
 
 
 
 def diff_degres(lat1, lon1, lat2, lon2):
     return math.hypot(lat1 - lat2, lon1 - lon2)
 
-def closest_cam_from_mag(Magnetometre, Fripon, k):
+EARTH_RADIUS_KM = 6371.0
+
+def _unit_vectors(lat, lon):
+    lat, lon = np.radians(np.asarray(lat, dtype=float)), np.radians(np.asarray(lon, dtype=float))
+    return np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+def _station_coords(stations, coords, epoch=QD_EPOCH):
+    """(noms, lat, lon) des stations en coordonnées géographiques ('geo') ou quasi-dipolaires ('qd')."""
+    names = list(stations)
+    lat = np.array([stations[n].lat for n in names], dtype=float)
+    lon = np.array([stations[n].lon for n in names], dtype=float)
+    if coords == "geo":
+        return names, lat, lon
+    if coords != "qd":
+        raise ValueError(f"coords doit être 'geo' ou 'qd', pas {coords!r}")
+    qdlat = np.array([getattr(stations[n], 'qdlat', np.nan) for n in names], dtype=float)
+    qdlon = np.array([getattr(stations[n], 'qdlon', np.nan) for n in names], dtype=float)
+    missing = ~(np.isfinite(qdlat) & np.isfinite(qdlon))
+    if missing.any():  # magnétomètres : conversion à la demande, via le cache QD
+        qdlat[missing], qdlon[missing] = get_qd_coords(lat[missing], lon[missing], epoch)
+    return names, qdlat, qdlon
+
+class stationindexclass:
+    """Index spatial d'un ensemble de stations, construit une fois par jeu de données.
+
+    Les stations sont placées sur la sphère unité (vecteurs 3-D) et rangées dans un
+    arbre KD (scipy si disponible, sinon recherche matricielle numpy) ; les distances
+    renvoyées sont des distances de grand cercle en km. Avec coords='qd', la sphère est
+    celle des coordonnées quasi-dipolaires, ce qui apparie les stations le long des
+    longitudes magnétiques.
+    """
+    def __init__(self, stations, coords="geo", epoch=QD_EPOCH):
+        self.coords, self.epoch = coords, epoch
+        self.names, self.lat, self.lon = _station_coords(stations, coords, epoch)
+        self.xyz = _unit_vectors(self.lat, self.lon)
+        cKDTree = _get_ckdtree()
+        self.tree = cKDTree(self.xyz) if cKDTree is not None and len(self.names) else None
+
+    def _chord_to_km(self, chord):
+        return 2 * EARTH_RADIUS_KM * np.arcsin(np.clip(chord / 2, 0, 1))
+
+    def query(self, lat, lon, k):
+        """k plus proches stations de chaque point : (distances km (n, k), indices (n, k))."""
+        xyz = _unit_vectors(np.atleast_1d(lat), np.atleast_1d(lon))
+        k = min(k, len(self.names))
+        if k == 0:
+            return np.empty((len(xyz), 0)), np.empty((len(xyz), 0), dtype=int)
+        if self.tree is not None:
+            chord, idx = self.tree.query(xyz, k=k)
+            chord, idx = chord.reshape(len(xyz), k), idx.reshape(len(xyz), k)
+        else:
+            chord_all = np.linalg.norm(xyz[:, None, :] - self.xyz[None, :, :], axis=2)
+            idx = np.argsort(chord_all, axis=1, kind='stable')[:, :k]
+            chord = np.take_along_axis(chord_all, idx, axis=1)
+        return self._chord_to_km(chord), idx
+
+    def query_radius(self, lat, lon, r_km):
+        """Pour chaque point, la liste triée des (distance km, nom) des stations à moins de r_km."""
+        xyz = _unit_vectors(np.atleast_1d(lat), np.atleast_1d(lon))
+        r_chord = 2 * np.sin(min(r_km / EARTH_RADIUS_KM, np.pi) / 2)
+        if self.tree is not None:
+            hits = self.tree.query_ball_point(xyz, r_chord)
+        else:
+            chord_all = np.linalg.norm(xyz[:, None, :] - self.xyz[None, :, :], axis=2)
+            hits = [np.flatnonzero(row <= r_chord) for row in chord_all]
+        out = []
+        for p, idx in zip(xyz, hits):
+            idx = np.asarray(idx, dtype=int)
+            d = self._chord_to_km(np.linalg.norm(self.xyz[idx] - p, axis=1))
+            order = np.argsort(d, kind='stable')
+            out.append([(float(d[j]), self.names[idx[j]]) for j in order])
+        return out
+
+@_profiled("closest_cam_from_mag")
+def closest_cam_from_mag(Magnetometre, Fripon, k, coords="geo", index=None):
+    """Caméras les plus proches de chaque magnétomètre, distances en km.
+
+    index : stationindexclass déjà construit sur Fripon (réutilisé d'un appel à l'autre).
+    """
+    if index is None:
+        index = stationindexclass(Fripon, coords=coords)
+    mnames, mlat, mlon = _station_coords(Magnetometre, index.coords, index.epoch)
     assoc_cam    = {}
     proches_cams = {}
-    for mname, mag in Magnetometre.items():
-        latm, lonm = mag.lat, mag.lon
-        heap = [
-            (diff_degres(latm, lonm, cam.lat, cam.lon), cname)
-            for cname, cam in Fripon.items()
-        ]
-        best = heapq.nsmallest(k, heap, key=lambda x: x[0])
+    dist, idx = index.query(mlat, mlon, k) if mnames else (np.empty((0, 0)), np.empty((0, 0), dtype=int))
+    for mname, drow, irow in zip(mnames, dist, idx):
+        best = [(float(d), index.names[i]) for d, i in zip(drow, irow)]
         if best:
             assoc_cam[mname]    = (best[0][1], best[0][0])
             proches_cams[mname] = best
@@ -118,16 +925,12 @@ def closest_cam_from_mag(Magnetometre, Fripon, k):
             proches_cams[mname] = []
     return assoc_cam, proches_cams
 
-def plot_graph(Magnetometre, Fripon, x_min, x_max, y_min, y_max, output_path):
-    assoc_cam, _ = closest_cam_from_mag(Magnetometre, Fripon, k=3)
-    for mname, mag in Magnetometre.items():
-        cname, dist = assoc_cam[mname]
-        if cname is None:
-            continue
-        dfm = mag.df.loc[x_min:x_max]
-        dfc = Fripon[cname].df.loc[x_min:x_max]
-        fig, ax1 = plt.subplots(figsize=(10,4))
-        ax1.plot(dfm.index, dfm['H'], color='tab:blue', label=f"{mname} ({mag.lat:.2f}°N)", linewidth=1.5)
+class _pairfigureclass:
+    """Gabarit réutilisable du graphe magnétomètre / caméra la plus proche (deux axes Y)."""
+    def __init__(self, x_min, x_max, y_min, y_max):
+        self.fig, self.ax1 = plt.subplots(figsize=(10,4))
+        ax1 = self.ax1
+        self.line_m, = ax1.plot(pd.DatetimeIndex([x_min, x_max]), [np.nan, np.nan], color='tab:blue', linewidth=1.5)
         ax1.set_xlabel("Time UTC")
         ax1.xaxis.set_major_formatter(mdates.DateFormatter("%H:%M"))
         ax1.set_ylabel("H component (nT)", color='tab:blue')
@@ -135,63 +938,221 @@ def plot_graph(Magnetometre, Fripon, x_min, x_max, y_min, y_max, output_path):
         ax1.set_xlim(x_min, x_max)
         ax1.grid(axis='x', linestyle='--', alpha=0.5)
 
-        ax2 = ax1.twinx()
-        ax2.plot(dfc.index, dfc['lumd'], color='tab:orange', label=f"{cname} ({Fripon[cname].lat:.2f}°N)", linewidth=1.5)
+        self.ax2 = ax2 = ax1.twinx()
+        self.line_c, = ax2.plot(pd.DatetimeIndex([x_min, x_max]), [np.nan, np.nan], color='tab:orange', linewidth=1.5)
         ax2.set_ylabel("Brightness (mag/arcsec²)", color='tab:orange')
         ax2.tick_params(axis='y', labelcolor='tab:orange')
         ax2.set_ylim(y_min, y_max)
-
-        h1,l1 = ax1.get_legend_handles_labels()
-        h2,l2 = ax2.get_legend_handles_labels()
-        ax1.legend(h1+h2, l1+l2, loc='lower left')
-
-        plt.title(f"{mname} & {cname} ({dist:.2f}° apart)")
-        out = f"{output_path}\\graph_{mname}_vs_{cname}.png"
-        print(f"{output_path}\\graph_{mname}_vs_{cname}")
-        plt.savefig(out, dpi=150)
-        plt.close()
-
-def plot_graph_stack(Magnetometre, Fripon, x_min, x_max, y_min, y_max, stack_mags, output_path):
-    assoc_cam, proches_cams = closest_cam_from_mag(Magnetometre, Fripon, k=1)
-    fig, axes = plt.subplots(len(stack_mags), 1, sharex=True, figsize=(12,3*len(stack_mags)))
-    for ax, mname in zip(axes, stack_mags):
-        mag = Magnetometre[mname]
-        dfm = mag.df.loc[x_min:x_max]
-        ax.plot(dfm.index, dfm['H'], color='tab:blue', linewidth=1, label=f"{mname} ({mag.lat:.2f}°N)")
-        ax.set_ylabel("H (nT)", color='tab:blue')
-        ax.tick_params(axis='y', labelcolor='tab:blue', labelsize=8)
-        ax.grid(axis='x', linestyle='--', alpha=0.3)
-
-        ax2 = ax.twinx()
-        for dist, cname in proches_cams[mname]:
-            dfc = Fripon[cname].df.loc[x_min:x_max]
-            ax2.plot(dfc.index, dfc['lumd'], color='tab:orange', linewidth=1.5, label=f"{cname} ({Fripon[cname].lat:.2f}°N)")
+        self.title = ax1.set_title("")
+
+    def update(self, mname, mag, dfm, cname, cam, dfc, dist, max_points=None, decimate="minmax"):
+        xm, ym, removed_m = _decimated(self.ax1, dfm.index, dfm['H'], max_points, decimate)
+        xc, yc, removed_c = _decimated(self.ax2, dfc.index, dfc['lumd'], max_points, decimate)
+        self.line_m.set_data(xm, ym)
+        self.line_m.set_label(f"{mname} ({mag.lat:.2f}°N)")
+        self.line_c.set_data(xc, yc)
+        self.line_c.set_label(f"{cname} ({cam.lat:.2f}°N)")
+        self.ax1.relim()
+        self.ax1.autoscale_view(scalex=False)
+        self.ax1.legend([self.line_m, self.line_c], [self.line_m.get_label(), self.line_c.get_label()], loc='lower left')
+        self.title.set_text(f"{mname} & {cname} ({dist:.0f} km apart)")
+        return removed_m + removed_c, len(dfm) + len(dfc)
+
+class _stackfigureclass:
+    """Gabarit réutilisable d'un graphe empilé : un panneau par magnétomètre, k caméras par panneau."""
+    def __init__(self, n_panels, k_cams, y_min, y_max):
+        self.fig, axes = plt.subplots(n_panels, 1, sharex=True, figsize=(12,3*n_panels), squeeze=False)
+        self.axes = axes[:, 0]
+        self.panels = []
+        for ax in self.axes:
+            line_m, = ax.plot([], [], color='tab:blue', linewidth=1)
+            ax.set_ylabel("H (nT)", color='tab:blue')
+            ax.tick_params(axis='y', labelcolor='tab:blue', labelsize=8)
+            ax.grid(axis='x', linestyle='--', alpha=0.3)
+            ax2 = ax.twinx()
+            lines_c = [ax2.plot([], [], color='tab:orange', linewidth=1.5)[0] for _ in range(k_cams)]
             ax2.set_ylabel("Brightness (mag/arcsec²)", color='tab:orange')
             ax2.tick_params(axis='y', labelcolor='tab:orange', labelsize=8)
-        ax2.set_ylim(y_min, y_max)
-        ax.set_title(mname, fontsize=9)
-        h1,l1 = ax.get_legend_handles_labels()
-        h2,l2 = ax2.get_legend_handles_labels()
-        ax.legend(h1+h2, l1+l2, loc='upper right', fontsize=7)
-
-    axes[-1].xaxis.set_major_formatter(mdates.DateFormatter("%H:%M"))
-    axes[-1].set_xlabel("Time UTC")
-    plt.tight_layout()
-    out = f"{output_path}\\stack_{'_'.join(stack_mags)}.png"
-    print(f"{output_path}\\stack_{'_'.join(stack_mags)}")
-    plt.savefig(out, dpi=150)
-    plt.close()
-
-
-
-def ploteurope(Fripon, cameras, Magnetometre, magnetos, x_min, x_max, y_min, y_max, output_path, last):
-    df_base = Magnetometre[magnetos[0]].df
-    times = df_base.loc[x_min:x_max].index
-
-    for t in times:
-        fig, ax = plt.subplots(figsize=(12, 12),
-                               subplot_kw={'projection': ccrs.NearsidePerspective(central_longitude=5, central_latitude=40, satellite_height=35785831)})
-
+            ax2.set_ylim(y_min, y_max)
+            self.panels.append((ax, line_m, lines_c))
+        self.axes[-1].xaxis_date()
+        self.axes[-1].xaxis.set_major_formatter(mdates.DateFormatter("%H:%M"))
+        self.axes[-1].set_xlabel("Time UTC")
+        self.fig.tight_layout()
+
+    def update(self, panels, max_points=None, decimate="minmax"):
+        # panels : [(mname, mag, dfm, [(cname, cam, dfc), ...]), ...]
+        removed = total = 0
+        for (ax, line_m, lines_c), (mname, mag, dfm, cams) in zip(self.panels, panels):
+            x, y, n_removed = _decimated(ax, dfm.index, dfm['H'], max_points, decimate)
+            removed, total = removed + n_removed, total + len(dfm)
+            line_m.set_data(x, y)
+            line_m.set_label(f"{mname} ({mag.lat:.2f}°N)")
+            shown = [line_m]
+            for line, cam_data in itertools.zip_longest(lines_c, cams):
+                if cam_data is None:
+                    line.set_data([], [])
+                    continue
+                cname, cam, dfc = cam_data
+                x, y, n_removed = _decimated(ax, dfc.index, dfc['lumd'], max_points, decimate)
+                removed, total = removed + n_removed, total + len(dfc)
+                line.set_data(x, y)
+                line.set_label(f"{cname} ({cam.lat:.2f}°N)")
+                shown.append(line)
+            ax.relim()
+            ax.autoscale_view()
+            ax.set_title(mname, fontsize=9)
+            ax.legend(shown, [l.get_label() for l in shown], loc='upper right', fontsize=7)
+        return removed, total
+
+class plotsessionclass:
+    """Session de tracés en lot magnétomètres / caméras.
+
+    Les associations (index spatial + k plus proches caméras) sont calculées une seule
+    fois ; chaque type de graphe utilise un gabarit de figure créé une fois puis mis à
+    jour en place. Les sorties vont en PNG ou dans un seul PDF multipage (pdf=chemin),
+    et le mode PNG peut se répartir sur un pool de processus (workers).
+    """
+    def __init__(self, Magnetometre, Fripon, k=3, coords="geo", associations=None):
+        self.Magnetometre = Magnetometre
+        self.Fripon       = Fripon
+        self.k            = k
+        self.index        = stationindexclass(Fripon, coords=coords)
+        # associations : résultat déjà calculé de closest_cam_from_mag (ex. cache du pipeline)
+        self.assoc_cam, self.proches_cams = associations or closest_cam_from_mag(Magnetometre, Fripon, k, index=self.index)
+
+    def _pair_jobs(self, mnames=None):
+        mnames = list(self.Magnetometre) if mnames is None else mnames
+        return [m for m in mnames if self.assoc_cam[m][0] is not None]
+
+    @_profiled("plot.pairs")
+    def _render_pairs(self, mnames, x_min, x_max, y_min, y_max, output_path, pdf=None, max_points=None, decimate="minmax"):
+        tpl = _pairfigureclass(x_min, x_max, y_min, y_max)
+        files = []
+        removed = total = 0
+        try:
+            for mname in mnames:
+                cname, dist = self.assoc_cam[mname]
+                mag, cam = self.Magnetometre[mname], self.Fripon[cname]
+                n_removed, n_total = tpl.update(mname, mag, mag.df.loc[x_min:x_max], cname, cam, cam.df.loc[x_min:x_max], dist,
+                                                max_points, decimate)
+                removed, total = removed + n_removed, total + n_total
+                if pdf is not None:
+                    with PROFILER.stage("savefig"):
+                        pdf.savefig(tpl.fig)
+                    continue
+                out = os.path.join(output_path, f"graph_{mname}_vs_{cname}.png")
+                print(out)
+                with PROFILER.stage("savefig"):
+                    tpl.fig.savefig(out, dpi=150)
+                files.append(out)
+        finally:
+            plt.close(tpl.fig)
+        if max_points is not None:
+            _report_decimation(removed, total)
+        return files
+
+    @_profiled("plot.stacks")
+    def _render_stacks(self, stacks, x_min, x_max, y_min, y_max, output_path, k_cams=1, pdf=None, max_points=None, decimate="minmax"):
+        templates, files = {}, []
+        removed = total = 0
+        try:
+            for stack_mags in stacks:
+                if len(stack_mags) not in templates:
+                    templates[len(stack_mags)] = _stackfigureclass(len(stack_mags), k_cams, y_min, y_max)
+                tpl = templates[len(stack_mags)]
+                panels = []
+                for mname in stack_mags:
+                    mag = self.Magnetometre[mname]
+                    cams = [(cname, self.Fripon[cname], self.Fripon[cname].df.loc[x_min:x_max])
+                            for _, cname in self.proches_cams[mname][:k_cams]]
+                    panels.append((mname, mag, mag.df.loc[x_min:x_max], cams))
+                n_removed, n_total = tpl.update(panels, max_points, decimate)
+                removed, total = removed + n_removed, total + n_total
+                if pdf is not None:
+                    with PROFILER.stage("savefig"):
+                        pdf.savefig(tpl.fig)
+                    continue
+                out = os.path.join(output_path, f"stack_{'_'.join(stack_mags)}.png")
+                print(out)
+                with PROFILER.stage("savefig"):
+                    tpl.fig.savefig(out, dpi=150)
+                files.append(out)
+        finally:
+            for tpl in templates.values():
+                plt.close(tpl.fig)
+        if max_points is not None:
+            _report_decimation(removed, total)
+        return files
+
+    def _run(self, render, jobs, args, output_path, pdf, workers, **kwargs):
+        if pdf is not None:
+            with backend_pdf.PdfPages(pdf) as pages:
+                render(jobs, *args, output_path, pdf=pages, **kwargs)
+            print(pdf)
+            return [pdf]
+        if not workers or workers <= 1 or len(jobs) <= 1:
+            return render(jobs, *args, output_path, **kwargs)
+        # Chaque processus reçoit la session une fois puis construit ses propres gabarits
+        chunk = math.ceil(len(jobs) / workers)
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_session_worker, initargs=(self,)) as pool:
+            futures = [pool.submit(_session_worker_task, render.__name__, jobs[i:i + chunk], args, output_path, kwargs)
+                       for i in range(0, len(jobs), chunk)]
+            return [f for fut in futures for f in fut.result()]
+
+    def plot_pairs(self, x_min, x_max, y_min, y_max, output_path, mnames=None, pdf=None, workers=None,
+                   max_points=None, decimate="minmax"):
+        """Graphe de chaque magnétomètre avec sa caméra la plus proche.
+
+        max_points : None (toutes les mesures), un nombre de points par série ou "auto"
+        (budget calé sur la largeur de l'axe en pixels) ; decimate : "minmax" ou "lttb".
+        """
+        return self._run(self._render_pairs, self._pair_jobs(mnames), (x_min, x_max, y_min, y_max), output_path, pdf, workers,
+                         max_points=max_points, decimate=decimate)
+
+    def plot_stacks(self, stacks, x_min, x_max, y_min, y_max, output_path, k_cams=1, pdf=None, workers=None,
+                    max_points=None, decimate="minmax"):
+        """Un graphe empilé par liste de magnétomètres de stacks, avec les k_cams caméras les plus proches."""
+        return self._run(self._render_stacks, [list(st) for st in stacks], (x_min, x_max, y_min, y_max),
+                         output_path, pdf, workers, k_cams=k_cams, max_points=max_points, decimate=decimate)
+
+_worker_session = None
+def _init_session_worker(session):
+    global _worker_session
+    matplotlib.use("Agg")
+    _worker_session = session
+
+def _session_worker_task(render_name, jobs, args, output_path, kwargs):
+    return getattr(_worker_session, render_name)(jobs, *args, output_path, **kwargs)
+
+def plot_graph(Magnetometre, Fripon, x_min, x_max, y_min, y_max, output_path, session=None, pdf=None, workers=None,
+               max_points=None, decimate="minmax"):
+    session = session or plotsessionclass(Magnetometre, Fripon, k=3)
+    return session.plot_pairs(x_min, x_max, y_min, y_max, output_path, pdf=pdf, workers=workers,
+                              max_points=max_points, decimate=decimate)
+
+def plot_graph_stack(Magnetometre, Fripon, x_min, x_max, y_min, y_max, stack_mags, output_path, session=None, pdf=None,
+                     max_points=None, decimate="minmax"):
+    session = session or plotsessionclass(Magnetometre, Fripon, k=1)
+    return session.plot_stacks([stack_mags], x_min, x_max, y_min, y_max, output_path, k_cams=1, pdf=pdf,
+                               max_points=max_points, decimate=decimate)
+
+
+
+class europemapclass:
+    """Carte d'Europe réutilisable pour les animations ploteurope*.
+
+    Le fond (côtes, frontières, terres, mers, lignes QD, barre de couleur) est rasterisé
+    une seule fois puis mémorisé ; chaque image ne fait que restaurer ce fond (blitting)
+    et redessiner le nuage de points des caméras et le titre.
+    """
+    @_profiled("map.background")
+    def __init__(self, lons, lats, cmap, norm, cbar_label, qd_lines=None, dpi=200):
+        self.fig, self.ax = plt.subplots(figsize=(12, 12), dpi=dpi,
+                                         subplot_kw={'projection': ccrs.NearsidePerspective(
+                                             central_longitude=5, central_latitude=40,
+                                             satellite_height=35785831)})
+        ax = self.ax
         ax.set_extent([-15, 30, 35, 65], crs=ccrs.PlateCarree())
 
         # Fond de carte
@@ -200,403 +1161,1108 @@ def ploteurope(Fripon, cameras, Magnetometre, magnetos, x_min, x_max, y_min, y_m
         ax.add_feature(cfeature.LAND, facecolor='black')
         ax.add_feature(cfeature.OCEAN, facecolor='gray')
         ax.add_feature(cfeature.LAKES, facecolor='gray')
-        # ax.add_feature(cfeature.RIVERS)
-
-        # --- Caméras ---
-        norm_cam = colors.Normalize(vmin=y_min, vmax=y_max)
-        for cam_name, cam in Fripon.items():
-            if t in cam.df.index:
-                val = cam.df.at[t, 'lumd']
-                last[cam_name] = t
-            elif cam_name in last:
-                val = cam.df.at[last[cam_name], 'lumd']
-            else:
-                continue  # aucune mesure
 
-            ax.plot(cam.lon, cam.lat,
-                    marker='o', markersize=8,
-                    color=plt.cm.Greys(norm_cam(val)),
-                    transform=ccrs.PlateCarree())
+        # --- Lignes QD marquées (5°) ---
+        for qd_lat, lons_geo, lats_geo in (qd_lines or []):
+            ax.plot(lons_geo, lats_geo,
+                    transform=ccrs.PlateCarree(),
+                    linestyle='--', color='white', linewidth=0.8, alpha=0.6, zorder=3)
+            mid = len(lons_geo) // 2
+            # Décalage vers la gauche en longitude (exemple 20°)
+            x_text = lons_geo[mid] - 20
+            y_text = lats_geo[mid]
+            ax.text(x_text, y_text, f"{qd_lat}°", transform=ccrs.PlateCarree(), fontsize=7, color='white', alpha=0.6, ha='center', va='bottom')
 
         # Barre de couleur pour les caméras
-        sm_cam = cm.ScalarMappable(cmap=plt.cm.Greys, norm=norm_cam)
+        cmap = plt.get_cmap(cmap).with_extremes(bad=(0, 0, 0, 0))  # caméras sans valeur invisibles
+        sm_cam = cm.ScalarMappable(cmap=cmap, norm=norm)
         sm_cam.set_array([])
-        cbar_cam = plt.colorbar(sm_cam, ax=ax, pad=0.02, fraction=0.04)
-        cbar_cam.set_label("Brightness (mag/arcsec²)", fontsize=10)
-
-        plt.title(t.strftime("%Y-%m-%d %H:%M"))
-        out_file = f"{output_path}\\{t:%Y%m%dT%H%M}.png"
+        cbar_cam = self.fig.colorbar(sm_cam, ax=ax, pad=0.02, fraction=0.04)
+        cbar_cam.set_label(cbar_label, fontsize=10)
+
+        # --- Caméras : un seul artiste, mis à jour à chaque image ---
+        self.scatter = ax.scatter(lons, lats, c=np.full(len(lons), np.nan), cmap=cmap, norm=norm,
+                                  s=64, marker='o', transform=ccrs.PlateCarree(), zorder=4, animated=True)
+        self.title = ax.set_title("", animated=True)
+
+        self.fig.canvas.draw()
+        self.background = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+
+    def render(self, values, title):
+        """Dessine une image et retourne le tampon RGBA (hauteur, largeur, 4) du canevas."""
+        canvas = self.fig.canvas
+        canvas.restore_region(self.background)
+        self.scatter.set_array(np.ma.masked_invalid(values))
+        self.title.set_text(title)
+        self.ax.draw_artist(self.scatter)
+        self.ax.draw_artist(self.title)
+        return np.asarray(canvas.buffer_rgba())
+
+    def close(self):
+        plt.close(self.fig)
+
+class _pngsink:
+    """Une image PNG par instant, nommée d'après son horodatage."""
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self.files = []
+
+    def write(self, rgba, t):
+        out_file = os.path.join(self.output_path, f"{t:%Y%m%dT%H%M}.png")
         print(out_file)
-        plt.savefig(out_file, dpi=200)
-        plt.close()
+        plt.imsave(out_file, rgba)
+        self.files.append(out_file)
+
+    def close(self):
+        return self.files
+
+    def abort(self):
+        pass
+
+class _videosink:
+    """Images brutes RGBA envoyées directement dans un pipe ffmpeg (mp4, gif, webm...)."""
+    def __init__(self, out_file, fps=10):
+        self.out_file, self.fps = out_file, fps
+        self.proc = None
+
+    def _open(self, height, width):
+        ffmpeg = matplotlib.rcParams['animation.ffmpeg_path']
+        cmd = [ffmpeg, '-y', '-loglevel', 'error',
+               '-f', 'rawvideo', '-pix_fmt', 'rgba', '-s', f"{width}x{height}", '-r', str(self.fps), '-i', '-']
+        if self.out_file.lower().endswith('.mp4'):
+            cmd += ['-c:v', 'libx264', '-pix_fmt', 'yuv420p']
+        self.proc = subprocess.Popen(cmd + [self.out_file], stdin=subprocess.PIPE)
+
+    def write(self, rgba, t):
+        if self.proc is None:
+            self._open(*rgba.shape[:2])
+        self.proc.stdin.write(np.ascontiguousarray(rgba).tobytes())
+
+    def close(self):
+        if self.proc is not None:
+            self.proc.stdin.close()
+            if self.proc.wait() != 0:
+                raise RuntimeError(f"ffmpeg a échoué lors de l'écriture de {self.out_file}")
+        print(self.out_file)
+        return [self.out_file]
+
+    def abort(self):
+        """Rendu interrompu : arrête ffmpeg (sans attendre la fin du pipe) et retire le fichier partiel."""
+        if self.proc is not None:
+            self.proc.kill()
+            self.proc.wait()
+            try:
+                self.proc.stdin.close()
+            except OSError:   # pipe cassé : des octets restaient dans le tampon
+                pass
+            if os.path.exists(self.out_file):
+                os.remove(self.out_file)
+
+def _open_frame_sink(output_path, times, output_format, fps):
+    if output_format == "png":
+        return _pngsink(output_path)
+    out_file = os.path.join(output_path, f"{times[0]:%Y%m%dT%H%M}_{times[-1]:%Y%m%dT%H%M}.{output_format}")
+    return _videosink(out_file, fps=fps)
+
+def _render_europe_chunk(europe, values, times):
+    return [europe.render(values[k], t.strftime("%Y-%m-%d %H:%M")).copy() for k, t in enumerate(times)]
+
+# Carte propre à chaque processus du pool, construite une seule fois par _init_europe_worker
+_worker_europe = None
+def _init_europe_worker(lons, lats, cmap, norm, cbar_label, qd_lines):
+    global _worker_europe
+    matplotlib.use("Agg")
+    _worker_europe = europemapclass(lons, lats, cmap, norm, cbar_label, qd_lines=qd_lines)
+
+def _europe_worker_task(values, times, output_path, output_format):
+    if output_format == "png":
+        # Les PNG sont écrits par le worker lui-même, seuls les noms reviennent au processus principal
+        sink = _pngsink(output_path)
+        for rgba, t in zip(_render_europe_chunk(_worker_europe, values, times), times):
+            sink.write(rgba, t)
+        return sink.close()
+    return _render_europe_chunk(_worker_europe, values, times)
+
+def _ploteurope_frames(cams, values, times, cmap, norm, cbar_label, output_path, qd_lines=None,
+                       workers=None, chunk_size=None, output_format="png", fps=10):
+    """Rend toutes les images, en PNG (output_format="png") ou directement dans une vidéo
+    ffmpeg (output_format="mp4", "gif", ...). Avec workers > 1, l'axe du temps est découpé
+    en blocs contigus répartis sur un pool de processus ; les blocs sont consommés dans
+    l'ordre, donc noms de fichiers et ordre des images ne dépendent pas de workers."""
+    if len(times) == 0:
+        return []
+    sink = _open_frame_sink(output_path, times, output_format, fps)
+    try:
+        if not workers or workers <= 1 or len(times) <= 1:
+            _render_frames_serial(cams, values, times, cmap, norm, cbar_label, qd_lines, sink)
+            return sink.close()
+        files = _render_frames_parallel(cams, values, times, cmap, norm, cbar_label, output_path, qd_lines,
+                                        workers, chunk_size, output_format, sink)
+    except BaseException:
+        sink.abort()   # pas de ffmpeg orphelin attendant sur son stdin
+        raise
+    return files if output_format == "png" else sink.close()
+
+# Mode vidéo : chaque image en transit est un tampon RGBA brut (~23 Mo en 2400×2400),
+# les blocs sont donc limités à quelques images pour que la mémoire dépende de workers, pas de n
+VIDEO_CHUNK_FRAMES = 4
+
+def _render_frames_serial(cams, values, times, cmap, norm, cbar_label, qd_lines, sink):
+    europe = europemapclass(cams.lon, cams.lat, cmap, norm, cbar_label, qd_lines=qd_lines)
+    try:
+        for k, t in enumerate(times):
+            with PROFILER.stage("frame.render"):
+                rgba = europe.render(values[k], t.strftime("%Y-%m-%d %H:%M"))
+            with PROFILER.stage("frame.write"):
+                sink.write(rgba, t)
+            PROFILER.count("frames")
+    finally:
+        europe.close()
+
+def _render_frames_parallel(cams, values, times, cmap, norm, cbar_label, output_path, qd_lines,
+                            workers, chunk_size, output_format, sink):
+    if chunk_size is None:
+        chunk_size = max(1, math.ceil(len(times) / (workers * 4)))
+        if output_format != "png":
+            chunk_size = min(chunk_size, VIDEO_CHUNK_FRAMES)
+    chunks = [(values[i:i + chunk_size], times[i:i + chunk_size]) for i in range(0, len(times), chunk_size)]
+    files, done = [], 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_europe_worker,
+                             initargs=(cams.lon, cams.lat, cmap, norm, cbar_label, qd_lines)) as pool:
+        # Fenêtre glissante d'au plus workers*2 blocs en cours : en mode vidéo, au plus
+        # workers*2*VIDEO_CHUNK_FRAMES images en mémoire, quelle que soit la durée
+        pending = deque()
+        todo = iter(chunks)
+        for v, t in itertools.islice(todo, workers * 2):
+            pending.append((pool.submit(_europe_worker_task, v, t, output_path, output_format), t))
+        while pending:
+            fut, t_chunk = pending.popleft()
+            result = fut.result()
+            if output_format == "png":
+                files += result
+            else:
+                for rgba, t in zip(result, t_chunk):
+                    with PROFILER.stage("frame.write"):
+                        sink.write(rgba, t)
+            PROFILER.count("frames", len(t_chunk))
+            done += len(t_chunk)
+            print(f"[{done}/{len(times)}] images rendues")
+            for v, t in itertools.islice(todo, 1):
+                pending.append((pool.submit(_europe_worker_task, v, t, output_path, output_format), t))
+    return files
+
+def ploteurope(Fripon, cameras, Magnetometre, magnetos, x_min, x_max, y_min, y_max, output_path, last=None, max_age=None, workers=None, output_format="png", fps=10):
+    # last : conservé pour compatibilité, l'état est désormais calculé par compute_snapshots
+    df_base = Magnetometre[magnetos[0]].df
+    times = df_base.loc[x_min:x_max].index
+    cams, snap = compute_snapshots(Fripon, times, max_age=max_age)
+
+    norm_cam = colors.Normalize(vmin=y_min, vmax=y_max)
+    _ploteurope_frames(cams, snap, times, "Greys", norm_cam, "Brightness (mag/arcsec²)", output_path,
+                       workers=workers, output_format=output_format, fps=fps)
 
 def find_lat_for_lon(lon, lat_mag, height_km, tol, step, date):
     for lat in np.arange(30, 90, step):
+        PROFILER.count("aacgm.calls")
+        PROFILER.count("aacgm.points")
         mlat, _, _ = aacgmv2.get_aacgm_coord(lat, lon, height_km, date)
         if abs(mlat - lat_mag) <= tol:
             return lat
     return np.nan
 
-def ploteuropetest(Fripon, cameras, Magnetometre, magnetos, x_min, x_max, y_min, y_max, output_path, last):
+_qd_lines_cache = {}
+@_profiled("qd.compute_qd_lines")
+def compute_qd_lines(qd_lats, lons, date, height_km=110, lat_min=30, lat_max=90, lat_step=0.25, cache_dir=CACHE_DIR):
+    """Isolignes de latitude QD en coordonnées géographiques, pour toutes les qd_lats d'un coup.
+
+    AACGM est évalué une seule fois sur la grille (lat, lon) vectorisée ; pour chaque
+    longitude, la latitude géographique où la latitude QD atteint qd_lat est obtenue par
+    interpolation linéaire au premier croisement. Le résultat est sauvegardé sur disque
+    (clé : date, hauteur, grille) pour que les runs suivants repartent en quelques ms.
+    Retourne une liste de (qd_lat, lons_geo, lats_geo) comme l'ancienne boucle find_lat_for_lon.
+    """
+    qd_lats = np.atleast_1d(np.asarray(qd_lats, dtype=float))
+    lons = np.atleast_1d(np.asarray(lons, dtype=float))
+    lats = np.arange(lat_min, lat_max, lat_step)
+    key = (date.strftime("%Y%m%dT%H%M"), float(height_km), float(lat_min), float(lat_max), float(lat_step),
+           lons.tobytes(), qd_lats.tobytes())
+    if key in _qd_lines_cache:
+        return _qd_lines_cache[key]
+
+    cache_file = None
+    if cache_dir is not None:
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()[:16]
+        cache_file = os.path.join(cache_dir, f"qdlines_{key[0]}_{int(height_km)}km_{digest}.npz")
+        if os.path.exists(cache_file):
+            with np.load(cache_file) as z:
+                geo = z["geo"]
+            qd_lines = _qd_lines_from_grid(qd_lats, lons, geo)
+            _qd_lines_cache[key] = qd_lines
+            return qd_lines
+
+    # Une seule évaluation AACGM sur toute la grille
+    lat_grid, lon_grid = np.meshgrid(lats, lons, indexing="ij")
+    PROFILER.count("aacgm.calls")
+    PROFILER.count("aacgm.points", lat_grid.size)
+    mlat, _, _ = aacgmv2.convert_latlon_arr(lat_grid.ravel(), lon_grid.ravel(), height_km, date)
+    mlat = np.asarray(mlat, dtype=float).reshape(lat_grid.shape)   # (n_lat, n_lon)
+
+    # Premier croisement mlat >= qd_lat le long de chaque colonne, puis interpolation
+    geo = np.full((len(qd_lats), len(lons)), np.nan)
+    valid = np.isfinite(mlat)
+    cols = np.arange(len(lons))
+    for i, qd_lat in enumerate(qd_lats):
+        above = valid & (mlat >= qd_lat)
+        idx = above.argmax(axis=0)
+        found = above[idx, cols] & (idx > 0)
+        i1 = idx[found]
+        i0 = i1 - 1
+        c = cols[found]
+        m0, m1 = mlat[i0, c], mlat[i1, c]
+        ok = np.isfinite(m0) & (m1 != m0)
+        frac = np.where(ok, (qd_lat - m0) / np.where(ok, m1 - m0, 1.0), np.nan)
+        geo[i, c] = lats[i0] + frac * lat_step
+
+    if cache_file is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        np.savez(cache_file, geo=geo, qd_lats=qd_lats, lons=lons)
+
+    qd_lines = _qd_lines_from_grid(qd_lats, lons, geo)
+    _qd_lines_cache[key] = qd_lines
+    return qd_lines
+
+def _qd_lines_from_grid(qd_lats, lons, geo):
+    qd_lines = []
+    for qd_lat, row in zip(qd_lats, geo):
+        ok = np.isfinite(row)
+        if ok.sum() > 2:
+            qd_lines.append((int(qd_lat) if float(qd_lat).is_integer() else float(qd_lat), lons[ok].tolist(), row[ok].tolist()))
+    return qd_lines
+
+def ploteuropetest(Fripon, cameras, Magnetometre, magnetos, x_min, x_max, y_min, y_max, output_path, last=None, max_age=None, workers=None, output_format="png", fps=10,
+                   qd_date=datetime.datetime(2024, 5, 10, 22, 0), qd_height=QD_HEIGHT):
     df_base = Magnetometre[magnetos[0]].df
     times = df_base.loc[x_min:x_max].index
+    cams, snap = compute_snapshots(Fripon, times, max_age=max_age)
 
-    # Pré-calcule les lignes QD tous les 5°
-    qd_lines = []
-    for qd_lat in range(30, 65, 5):
-        lats_geo = []
-        lons_geo = []
-        for lon in np.linspace(-40, 60, 300):
-            date = datetime.datetime(2024, 5, 10, 22, 0)
-            lat_geo = find_lat_for_lon(lon, qd_lat, height_km=110, tol=0.1, step=0.05, date=date)
-            if not np.isnan(lat_geo):
-                lats_geo.append(lat_geo)
-                lons_geo.append(lon)
-        if len(lats_geo) > 2:
-            qd_lines.append((qd_lat, lons_geo, lats_geo))
+    # Pré-calcule les lignes QD tous les 5° (à l'époque QD des caméras)
+    qd_lines = compute_qd_lines(range(30, 65, 5), np.linspace(-40, 60, 300), date=qd_date, height_km=qd_height)
 
     # Génère une image par instant
-    for t in times:
-        fig, ax = plt.subplots(figsize=(12, 12),
-                               subplot_kw={'projection': ccrs.NearsidePerspective(
-                                   central_longitude=5, central_latitude=40,
-                                   satellite_height=35785831)})
-
-        ax.set_extent([-15, 30, 35, 65], crs=ccrs.PlateCarree())
+    norm_cam = colors.Normalize(vmin=y_min, vmax=y_max)
+    _ploteurope_frames(cams, snap, times, "Greys", norm_cam, "Brightness (mag/arcsec²)", output_path, qd_lines,
+                       workers=workers, output_format=output_format, fps=fps)
 
-        # Fond de carte
-        ax.add_feature(cfeature.COASTLINE)
-        ax.add_feature(cfeature.BORDERS, linestyle='--')
-        ax.add_feature(cfeature.LAND, facecolor='black')
-        ax.add_feature(cfeature.OCEAN, facecolor='gray')
-        ax.add_feature(cfeature.LAKES, facecolor='gray')
-
-        # --- Caméras ---
-        norm_cam = colors.Normalize(vmin=y_min, vmax=y_max)
-        for cam_name, cam in Fripon.items():
-            if t in cam.df.index:
-                val = cam.df.at[t, 'lumd']
-                last[cam_name] = t
-            elif cam_name in last:
-                val = cam.df.at[last[cam_name], 'lumd']
-            else:
-                continue  # aucune mesure
-
-            ax.plot(cam.lon, cam.lat,
-                    marker='o', markersize=8,
-                    color=plt.cm.Greys(norm_cam(val)),
-                    transform=ccrs.PlateCarree())
-
-        # --- Lignes QD marquées (5°) ---
-        for qd_lat, lons_geo, lats_geo in qd_lines:
-            ax.plot(lons_geo, lats_geo,
-                    transform=ccrs.PlateCarree(),
-                    linestyle='--', color='white', linewidth=0.8, alpha=0.6, zorder=3)
-            mid = len(lons_geo) // 2
-            # Décalage vers la gauche en longitude (exemple 20°)
-            x_text = lons_geo[mid] - 20
-            y_text = lats_geo[mid]  
-            ax.text(x_text, y_text, f"{qd_lat}°",transform=ccrs.PlateCarree(),fontsize=7, color='white', alpha=0.6, ha='center', va='bottom')
-
-        # Barre de couleur pour les caméras
-        sm_cam = cm.ScalarMappable(cmap=plt.cm.Greys, norm=norm_cam)
-        sm_cam.set_array([])
-        cbar_cam = plt.colorbar(sm_cam, ax=ax, pad=0.02, fraction=0.04)
-        cbar_cam.set_label("Brightness (mag/arcsec²)", fontsize=10)
-
-        plt.title(t.strftime("%Y-%m-%d %H:%M"))
-        out_file = f"{output_path}\\{t:%Y%m%dT%H%M}.png"
-        print(out_file)
-        plt.savefig(out_file, dpi=200)
-        plt.close()
-
-def ploteuropedelta(Fripon, cameras, Magnetometre, magnetos, x_min, x_max, y_min, y_max, output_path, last, ref_time_str="2024-05-10 21:40"):
-    ref_time = pd.to_datetime(ref_time_str)
+def ploteuropedelta(Fripon, cameras, Magnetometre, magnetos, x_min, x_max, y_min, y_max, output_path, last=None, ref_time_str="2024-05-10 21:40", max_age=None, workers=None, output_format="png", fps=10,
+                    baseline="nearest", ref_start=None, ref_end=None, nights=3, tod_bin="10min",
+                    qd_date=datetime.datetime(2024, 5, 10, 22, 0), qd_height=QD_HEIGHT):
     df_base = Magnetometre[magnetos[0]].df
     times = df_base.loc[x_min:x_max].index
 
-    # Pré-calcule les luminosités de référence pour chaque caméra
-    ref_lumd_dict = {}
-    for cam_name, cam in Fripon.items():
-        df = cam.df
-        if df.empty:
-            continue
-        closest_index = df.index.get_indexer([ref_time], method='nearest')[0]
-        ref_lumd_dict[cam_name] = df.iloc[closest_index]['lumd']
+    # Écarts à la luminosité de référence de chaque caméra (voir compute_baseline)
+    delta_matrix = compute_delta(Fripon, baseline, ref_time=pd.to_datetime(ref_time_str), ref_start=ref_start, ref_end=ref_end,
+                                 nights=nights, tod_bin=tod_bin)
+    cams, delta = compute_snapshots(delta_matrix, times, max_age=max_age)
 
-    # Pré-calcule les lignes QD tous les 5°
-    qd_lines = []
-    for qd_lat in range(30, 65, 5):
-        lats_geo = []
-        lons_geo = []
-        for lon in np.linspace(-40, 60, 300):
-            date = datetime.datetime(2024, 5, 10, 22, 0)
-            lat_geo = find_lat_for_lon(lon, qd_lat, height_km=110, tol=0.1, step=0.05, date=date)
-            if not np.isnan(lat_geo):
-                lats_geo.append(lat_geo)
-                lons_geo.append(lon)
-        if len(lats_geo) > 2:
-            qd_lines.append((qd_lat, lons_geo, lats_geo))
+    # Pré-calcule les lignes QD tous les 5° (à l'époque QD des caméras)
+    qd_lines = compute_qd_lines(range(30, 65, 5), np.linspace(-40, 60, 300), date=qd_date, height_km=qd_height)
 
     # Génère une image par instant
-    for t in times:
-        fig, ax = plt.subplots(figsize=(12, 12),
-                               subplot_kw={'projection': ccrs.NearsidePerspective(
-                                   central_longitude=5, central_latitude=40,
-                                   satellite_height=35785831)})
-
-        ax.set_extent([-15, 30, 35, 65], crs=ccrs.PlateCarree())
-
-        # Fond de carte
-        ax.add_feature(cfeature.COASTLINE)
-        ax.add_feature(cfeature.BORDERS, linestyle='--')
-        ax.add_feature(cfeature.LAND, facecolor='black')
-        ax.add_feature(cfeature.OCEAN, facecolor='gray')
-        ax.add_feature(cfeature.LAKES, facecolor='gray')
-
-        # --- Caméras ---
-        norm_cam = colors.Normalize(vmin=-3, vmax=3)  # centrée sur la différence
-        for cam_name, cam in Fripon.items():
-            if t in cam.df.index:
-                lumd = cam.df.at[t, 'lumd']
-                last[cam_name] = t
-            elif cam_name in last:
-                lumd = cam.df.at[last[cam_name], 'lumd']
-            else:
-                continue  # aucune mesure
-
-            ref_lumd = ref_lumd_dict.get(cam_name)
-            if ref_lumd is None:
-                continue
-
-            delta_lumd = lumd - ref_lumd
-
-            ax.plot(cam.lon, cam.lat,
-                    marker='o', markersize=8,
-                    color=plt.cm.berlin(norm_cam(delta_lumd)),
-                    transform=ccrs.PlateCarree())
-
-        # --- Lignes QD marquées (5°) ---
-        for qd_lat, lons_geo, lats_geo in qd_lines:
-            ax.plot(lons_geo, lats_geo,
-                    transform=ccrs.PlateCarree(),
-                    linestyle='--', color='white', linewidth=0.8, alpha=0.6, zorder=3)
-            mid = len(lons_geo) // 2
-            x_text = lons_geo[mid] - 20
-            y_text = lats_geo[mid]  
-            ax.text(x_text, y_text, f"{qd_lat}°", transform=ccrs.PlateCarree(), fontsize=7, color='white', alpha=0.6, ha='center', va='bottom')
-
-        # Barre de couleur pour les caméras
-        sm_cam = cm.ScalarMappable(cmap=plt.cm.berlin, norm=norm_cam)
-        sm_cam.set_array([])
-        cbar_cam = plt.colorbar(sm_cam, ax=ax, pad=0.02, fraction=0.04)
-        cbar_cam.set_label("Δ Brightness (mag/arcsec²)", fontsize=10)
-
-        plt.title(t.strftime("%Y-%m-%d %H:%M"))
-        out_file = f"{output_path}\\{t:%Y%m%dT%H%M}.png"
-        print(out_file)
-        plt.savefig(out_file, dpi=200)
-        plt.close()
-
-
-
-def plot_brightness_vs_qd_latitude(Fripon, x_min, x_max, lat_min, lat_max, y_min, y_max, output_path):
-    import matplotlib.dates as mdates
-    from matplotlib.colors import Normalize
-    from matplotlib.cm import ScalarMappable
-
-    # plt.style.use('dark_background')
+    norm_cam = colors.Normalize(vmin=-3, vmax=3)  # centrée sur la différence
+    _ploteurope_frames(cams, delta, times, "berlin", norm_cam, "Δ Brightness (mag/arcsec²)", output_path, qd_lines,
+                       workers=workers, output_format=output_format, fps=fps)
+
+
+
+class keogramclass:
+    """Keogramme : grille (latitude QD × temps) des valeurs de toutes les caméras.
+
+    grid[i, j] agrège (moyenne ou médiane) les mesures des caméras dont la latitude QD
+    tombe dans [qd_edges[i], qd_edges[i+1]) et prises dans [time_edges[j], time_edges[j+1]).
+    count[i, j] est le nombre de mesures agrégées (0 -> grid vaut NaN).
+    """
+    def __init__(self, qd_edges, time_edges, grid, count, agg):
+        self.qd_edges   = qd_edges
+        self.time_edges = time_edges
+        self.grid       = grid
+        self.count      = count
+        self.agg        = agg
+
+    def render(self, ax, cmap, norm):
+        return ax.pcolormesh(self.time_edges, self.qd_edges, np.ma.masked_invalid(self.grid),
+                             cmap=cmap, norm=norm, shading='flat')
+
+    def save(self, out_file):
+        """Export .npz (grid, count, qd_edges, time_edges en datetime64[ns]) pour analyse."""
+        np.savez(out_file, grid=self.grid, count=self.count, qd_edges=self.qd_edges,
+                 time_edges=np.asarray(self.time_edges, dtype='datetime64[ns]'), agg=self.agg)
+
+@_profiled("build_keogram")
+def build_keogram(Fripon, x_min, x_max, lat_min, lat_max, lat_bin=0.2, time_bin="10min", agg="mean", values=None):
+    """Répartit toutes les mesures des caméras dans une grille (latitude QD × temps).
+
+    Fripon : dict de caméras ou stationmatrixclass. values : matrice (caméras × temps) alignée
+    sur la matrice des caméras à utiliser à la place de lumd (par ex. un delta de luminosité).
+    """
+    if agg not in ("mean", "median"):
+        raise ValueError(f"agg doit être 'mean' ou 'median', pas {agg!r}")
+    matrix = as_station_matrix(Fripon, 'lumd')
+    data = matrix.data if values is None else values
+    j0 = matrix.times.searchsorted(pd.Timestamp(x_min), side='left')
+    j1 = matrix.times.searchsorted(pd.Timestamp(x_max), side='right')
+    times, data, mask = matrix.times[j0:j1], data[:, j0:j1], matrix.mask[:, j0:j1]
+
+    qd_edges = np.arange(lat_min, lat_max + lat_bin / 2, lat_bin)
+    time_edges = pd.date_range(pd.Timestamp(x_min).floor(time_bin), pd.Timestamp(x_max), freq=time_bin)
+    time_edges = time_edges.append(pd.DatetimeIndex([time_edges[-1] + pd.Timedelta(time_bin)]))
+    n_rows, n_cols = len(qd_edges) - 1, len(time_edges) - 1
+
+    rows = np.floor((matrix.qdlat - lat_min) / lat_bin).astype(int)                # par caméra
+    cols = np.searchsorted(time_edges.as_unit('ns').asi8, times.as_unit('ns').asi8, side='right') - 1  # par instant
+    st, tj = np.nonzero(mask & np.isfinite(data))
+    r, c, v = rows[st], cols[tj], data[st, tj]
+    keep = (r >= 0) & (r < n_rows) & (c >= 0) & (c < n_cols)
+    cell, v = r[keep] * n_cols + c[keep], v[keep]
+
+    count = np.bincount(cell, minlength=n_rows * n_cols)
+    if agg == "mean":
+        total = np.bincount(cell, weights=v, minlength=n_rows * n_cols)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            grid = total / count
+    else:
+        order = np.lexsort((v, cell))
+        v = v[order]
+        starts = np.concatenate([[0], np.cumsum(count)[:-1]])
+        filled = count > 0
+        lo = starts[filled] + (count[filled] - 1) // 2
+        hi = starts[filled] + count[filled] // 2
+        grid = np.full(n_rows * n_cols, np.nan)
+        grid[filled] = (v[lo] + v[hi]) / 2
+    grid = np.where(count > 0, grid, np.nan)
+    return keogramclass(qd_edges, time_edges, grid.reshape(n_rows, n_cols), count.reshape(n_rows, n_cols), agg)
+
+def _plot_keogram(keo, cmap, norm, lat_min, lat_max, cbar_label, title, out):
     fig, ax = plt.subplots(figsize=(12, 6))
     ax.set_facecolor('black')
-    cmap = plt.get_cmap('viridis_r')
-    norm = Normalize(vmin=y_min, vmax=y_max)
-
-    for name, cam in Fripon.items():
-        df = cam.df.loc[x_min:x_max]
-        if df.empty:
-            continue
-
-        qd_lat = cam.qdlat
-        df = df.copy()
-        df["next_time"] = df.index.to_series().shift(-1)
-        df["duration"] = (df["next_time"] - df.index.to_series()).fillna(pd.Timedelta(minutes=10))
-        df = df.dropna()
-
-        ax.barh(
-            y=[qd_lat] * len(df),
-            width=df["duration"],
-            left=df.index,
-            height=0.2,
-            color=cmap(norm(df["lumd"])),
-            edgecolor="none"
-        )
-
+    keo.render(ax, cmap, norm)
     ax.set_xlabel("Time (UTC)")
     ax.set_ylabel("Magnetic QD Latitude (°)")
     ax.set_ylim(lat_min, lat_max)
     ax.xaxis.set_major_formatter(mdates.DateFormatter("%H:%M"))
     ax.tick_params(axis='x', rotation=30)
-    sm = ScalarMappable(cmap=cmap, norm=norm)
-    sm.set_array([])
-    plt.colorbar(sm, ax=ax, label="Brightness (mag/arcsec²)")
-    plt.title("Brightness by Magnetic QD Latitude and Time")
-    plt.tight_layout()
-    out = f"{output_path}\\Brightness.png"
-    plt.savefig(out, dpi=150)
-    plt.show()
-    plt.close()
-    print(f"{output_path}\\Brightness.png")
-
-def plot_brightness_delta_vs_qd_latitude(Fripon, x_min, x_max, lat_min, lat_max, output_path, ref_time_str="2024-05-10 21:40"):
-    ref_time = pd.to_datetime(ref_time_str)
-    # plt.style.use('dark_background')
-    fig, ax = plt.subplots(figsize=(12, 6))
-    ax.set_facecolor('black')
-    cmap = plt.get_cmap('berlin')
-    norm = Normalize(vmin=-3, vmax=3)  # Ajustable selon tes écarts attendus
-
-    for name, cam in Fripon.items():
-        df = cam.df.loc[x_min:x_max].copy()
-        if df.empty:
-            continue
-
-        # Trouve la valeur la plus proche de 21h50 pour cette caméra
-        closest_index = df.index.get_indexer([ref_time], method='nearest')[0]
-        t_ref = df.index[closest_index]
-        ref_lumd = df.iloc[closest_index]['lumd']
-
-        # Calcul des différences
-        df['delta_lumd'] = df['lumd'] - ref_lumd
-        df['next_time'] = df.index.to_series().shift(-1)
-        df['duration'] = (df['next_time'] - df.index.to_series()).fillna(pd.Timedelta(minutes=10))
-        df = df.dropna()
-
-        qd_lat = cam.qdlat
-        ax.barh(
-            y=[qd_lat] * len(df),
-            width=df["duration"],
-            left=df.index,
-            height=0.2,
-            color=cmap(norm(df["delta_lumd"])),
-            edgecolor="none"
-        )
-
-    ax.set_xlabel("Time (UTC)")
-    ax.set_ylabel("Magnetic QD Latitude (°)")
-    ax.set_ylim(lat_min, lat_max)
-    ax.xaxis.set_major_formatter(mdates.DateFormatter("%H:%M"))
-    ax.tick_params(axis='x', rotation=30)
-
-    sm = ScalarMappable(cmap=cmap, norm=norm)
+    sm = cm.ScalarMappable(cmap=cmap, norm=norm)
     sm.set_array([])
-    plt.colorbar(sm, ax=ax, label="Δ Brightness (mag/arcsec²) from 21:40")
-    plt.title("Brightness Variation from Nearest 21:40 by Magnetic QD Latitude")
+    plt.colorbar(sm, ax=ax, label=cbar_label)
+    plt.title(title)
     plt.tight_layout()
-    out = f"{output_path}\\Delta_Brightness.png"
-    plt.savefig(out, dpi=150)
-    plt.show()
+    with PROFILER.stage("savefig"):
+        plt.savefig(out, dpi=150)
+    _show()
     plt.close()
-    print(f"{output_path}\\Delta_Brightness.png")    
-
-def plot_brightness_delta_vs_qd_latitude_mean(Fripon, x_min, x_max, lat_min, lat_max, output_path):
-    fig, ax = plt.subplots(figsize=(12, 6))
-    ax.set_facecolor('black')
-    cmap = plt.get_cmap('berlin')
-    norm = Normalize(vmin=-3, vmax=3)  # Ajustable selon tes écarts attendus
-
-    ref_start = pd.Timestamp("2024-05-10 00:00:00")
-    ref_end = pd.Timestamp("2024-05-10 01:30:00")
-
-    for name, cam in Fripon.items():
-        full_df = cam.df.copy()
-
-        # Synchroniser le fuseau horaire si besoin
-        if full_df.index.tz is not None:
-            ref_start_tz = ref_start.tz_localize(full_df.index.tz)
-            ref_end_tz = ref_end.tz_localize(full_df.index.tz)
-        else:
-            ref_start_tz = ref_start
-            ref_end_tz = ref_end
+    print(out)
 
-        # Calcul de la moyenne entre 00h00 et 01h30
-        ref_period = full_df.loc[ref_start_tz:ref_end_tz]
-        if ref_period.empty:
-            print(f"Avertissement : Pas de données pour la caméra {name} entre {ref_start_tz} et {ref_end_tz}")
+def plot_brightness_vs_qd_latitude(Fripon, x_min, x_max, lat_min, lat_max, y_min, y_max, output_path, time_bin="10min", agg="mean"):
+    keo = build_keogram(Fripon, x_min, x_max, lat_min, lat_max, time_bin=time_bin, agg=agg)
+    _plot_keogram(keo, plt.get_cmap('viridis_r'), colors.Normalize(vmin=y_min, vmax=y_max), lat_min, lat_max,
+                  "Brightness (mag/arcsec²)", "Brightness by Magnetic QD Latitude and Time",
+                  os.path.join(output_path, "Brightness.png"))
+    return keo
+
+def plot_brightness_delta_vs_qd_latitude(Fripon, x_min, x_max, lat_min, lat_max, output_path, ref_time_str="2024-05-10 21:40", time_bin="10min", agg="mean"):
+    # Valeur la plus proche de ref_time pour chaque caméra (dans la fenêtre affichée)
+    matrix = as_station_matrix(Fripon, 'lumd').window(x_min, x_max)
+    delta = compute_delta(matrix, "nearest", ref_time=pd.to_datetime(ref_time_str))
+    keo = build_keogram(delta, x_min, x_max, lat_min, lat_max, time_bin=time_bin, agg=agg)
+    _plot_keogram(keo, plt.get_cmap('berlin'), colors.Normalize(vmin=-3, vmax=3), lat_min, lat_max,  # Ajustable selon tes écarts attendus
+                  "Δ Brightness (mag/arcsec²) from 21:40", "Brightness Variation from Nearest 21:40 by Magnetic QD Latitude",
+                  os.path.join(output_path, "Delta_Brightness.png"))
+    return keo
+
+def plot_brightness_delta_vs_qd_latitude_mean(Fripon, x_min, x_max, lat_min, lat_max, output_path, time_bin="10min", agg="mean",
+                                              ref_start="2024-05-10 00:00:00", ref_end="2024-05-10 01:30:00", baseline="mean"):
+    # Moyenne (ou médiane) de chaque caméra entre ref_start et ref_end, 00h00–01h30 par défaut
+    matrix = as_station_matrix(Fripon, 'lumd')
+    ref_lumd = compute_baseline(matrix, baseline, ref_start=ref_start, ref_end=ref_end)
+    for name in np.asarray(matrix.names)[np.isnan(ref_lumd)]:
+        print(f"Avertissement : Pas de données pour la caméra {name} entre {ref_start} et {ref_end}")
+
+    delta = compute_delta(matrix, baseline, ref_start=ref_start, ref_end=ref_end)
+    keo = build_keogram(delta, x_min, x_max, lat_min, lat_max, time_bin=time_bin, agg=agg)
+    _plot_keogram(keo, plt.get_cmap('berlin'), colors.Normalize(vmin=-3, vmax=3), lat_min, lat_max,
+                  f"Δ Brightness (mag/arcsec²) from {pd.Timestamp(ref_start):%H:%M}–{pd.Timestamp(ref_end):%H:%M} {baseline.capitalize()}",
+                  "Brightness Variation by Magnetic QD Latitude",
+                  os.path.join(output_path, "Delta_Brightness_mean.png"))
+    return keo
+
+
+# --- Corrélations croisées magnétomètres / caméras ---
+def _resample_rows(matrix, grid, max_gap):
+    """Interpole chaque station sur la grille régulière ; masque les trous de plus de max_gap."""
+    g = grid.as_unit('ns').asi8
+    t = matrix.times.as_unit('ns').asi8
+    out = np.zeros((len(matrix), len(g)))
+    valid = np.zeros((len(matrix), len(g)), dtype=bool)
+    for i in range(len(matrix)):
+        ok = matrix.mask[i]
+        if ok.sum() < 2:
             continue
-        ref_lumd = ref_period['lumd'].mean()
-
-        # Puis on filtre uniquement les données à afficher
-        df = full_df.loc[x_min:x_max].copy()
-        if df.empty:
+        ti, vi = t[ok], matrix.data[i, ok]
+        j = np.searchsorted(ti, g, side='right')
+        inside = (j > 0) & (j < len(ti))
+        gap = np.full(len(g), np.iinfo(np.int64).max)
+        gap[inside] = ti[j[inside]] - ti[j[inside] - 1]
+        exact = np.isin(g, ti)
+        valid[i] = exact | (inside & (gap <= max_gap.value))
+        out[i] = np.where(valid[i], np.interp(g, ti, vi), 0.0)
+    return out, valid
+
+def _masked_xcorr(a, wa, b, wb, max_lag):
+    """Corrélation normalisée (Pearson sur le recouvrement) de chaque ligne de a avec b, pour
+    les décalages -max_lag..max_lag, en une série de FFT sur toutes les paires (Padfield 2012).
+    r[p, l] compare a(t) et b(t + lag) : un décalage positif signifie que b suit a."""
+    n = a.shape[1]
+    nfft = 1 << int(np.ceil(np.log2(2 * n)))
+    fft = lambda x: np.fft.rfft(x, nfft, axis=1)
+    def xc(x_f, y_f):
+        full = np.fft.irfft(np.conj(x_f) * y_f, nfft, axis=1)
+        return np.concatenate([full[:, nfft - max_lag:], full[:, :max_lag + 1]], axis=1)
+    a, b, wa, wb = a * wa, b * wb, wa.astype(float), wb.astype(float)
+    A, B, WA, WB = fft(a), fft(b), fft(wa), fft(wb)
+    N   = np.round(xc(WA, WB))
+    Sa  = xc(A, WB)
+    Sb  = xc(WA, B)
+    Saa = xc(fft(a * a), WB)
+    Sbb = xc(WA, fft(b * b))
+    Sab = xc(A, B)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        num = Sab - Sa * Sb / N
+        den = np.sqrt(np.clip(Saa - Sa ** 2 / N, 0, None) * np.clip(Sbb - Sb ** 2 / N, 0, None))
+        r = num / den
+    return np.where((N > 2) & (den > 0), r, np.nan), N
+
+@_profiled("cross_correlate_pairs")
+def cross_correlate_pairs(Magnetometre, Fripon, k=3, x_min=None, x_max=None, max_lag=60, resample="1min",
+                          max_gap="30min", min_overlap=30, index=None):
+    """Corrélation croisée décalée entre la composante H de chaque magnétomètre et ses k caméras
+    les plus proches, calculée pour toutes les paires d'un coup.
+
+    max_lag en minutes (ou Timedelta). Retourne un DataFrame trié par |corr| décroissante :
+    mag, cam, dist_km, lag_min (positif : la caméra suit le magnétomètre), corr (au pic),
+    corr_0 (sans décalage) et n (mesures en recouvrement au pic).
+    """
+    columns = ["mag", "cam", "dist_km", "lag_min", "corr", "corr_0", "n"]
+    _, proches = closest_cam_from_mag(Magnetometre, Fripon, k, index=index)
+    pairs = [(m, c, d) for m, best in proches.items() for d, c in best]
+    mags, cams = as_station_matrix(Magnetometre, 'H'), as_station_matrix(Fripon, 'lumd')
+    if not pairs or not len(mags.times) or not len(cams.times):
+        return pd.DataFrame(columns=columns)
+
+    x_min = pd.Timestamp(x_min) if x_min is not None else max(mags.times[0], cams.times[0])
+    x_max = pd.Timestamp(x_max) if x_max is not None else min(mags.times[-1], cams.times[-1])
+    grid = pd.date_range(x_min.ceil(resample), x_max, freq=resample)
+    if len(grid) < 2:  # archives sans recouvrement, ou x_min > x_max
+        return pd.DataFrame(columns=columns)
+    step = pd.Timedelta(resample)
+    max_lag = max_lag if isinstance(max_lag, pd.Timedelta) else pd.Timedelta(minutes=max_lag)
+    lag_steps = min(int(max_lag / step), max(len(grid) - 1, 0))
+
+    mag_vals, mag_ok = _resample_rows(mags, grid, pd.Timedelta(max_gap))
+    cam_vals, cam_ok = _resample_rows(cams, grid, pd.Timedelta(max_gap))
+    mi = np.array([mags._pos[m] for m, _, _ in pairs])
+    ci = np.array([cams._pos[c] for _, c, _ in pairs])
+    r, n = _masked_xcorr(mag_vals[mi], mag_ok[mi], cam_vals[ci], cam_ok[ci], lag_steps)
+    r = np.where(n >= min_overlap, r, np.nan)
+
+    has = np.isfinite(r).any(axis=1)
+    best = np.where(has, np.nanargmax(np.where(np.isfinite(r), np.abs(r), -1), axis=1), lag_steps)
+    rows = np.arange(len(pairs))
+    out = pd.DataFrame({
+        "mag":     [m for m, _, _ in pairs],
+        "cam":     [c for _, c, _ in pairs],
+        "dist_km": [d for _, _, d in pairs],
+        "lag_min": np.where(has, (best - lag_steps) * step / pd.Timedelta(minutes=1), np.nan),
+        "corr":    np.where(has, r[rows, best], np.nan),
+        "corr_0":  r[:, lag_steps],
+        "n":       n[rows, best].astype(int),
+    })
+    return out.sort_values("corr", key=np.abs, ascending=False, na_position='last').reset_index(drop=True)
+
+
+# --- Détection d'activité : dH/dt et débuts de sous-orages ---
+@_profiled("detect_onsets")
+def detect_onsets(Magnetometre, dhdt_threshold=5.0, var_window="10min", var_threshold=None, min_separation="30min"):
+    """Détecte les débuts de baisse rapide de H sur tout le réseau en une passe vectorisée.
+
+    Un événement est émis quand dH/dt (nT/min, entre deux mesures successives) passe sous
+    -dhdt_threshold (et, si var_threshold est donné, que la variance de H sur var_window
+    dépasse var_threshold) ; les nouveaux franchissements à moins de min_separation du
+    précédent sur la même station sont ignorés. Retourne un DataFrame
+    (time, station, qdlat, qdlon, dhdt, variance) trié par date.
+    """
+    matrix = as_station_matrix(Magnetometre, 'H')
+    columns = ["time", "station", "qdlat", "qdlon", "dhdt", "variance"]
+    if not len(matrix) or not len(matrix.times):
+        return pd.DataFrame(columns=columns)
+    t = matrix.times.as_unit('ns').asi8
+    prev, _ = matrix._neighbours()
+    mask = matrix.mask
+    # Mesure valide précédente (strictement avant la colonne j)
+    p = np.concatenate([np.full((len(matrix), 1), -1), prev[:, :-1]], axis=1)
+    rows = np.arange(len(matrix))[:, None]
+    has_prev = mask & (p >= 0)
+    dt_min = (t[None, :] - t[np.maximum(p, 0)]) / 60e9
+    with np.errstate(invalid='ignore', divide='ignore'):
+        dhdt = np.where(has_prev, (matrix.data - matrix.data[rows, np.maximum(p, 0)]) / dt_min, np.nan)
+
+    variance = _rolling_variance(matrix, pd.Timedelta(var_window))
+    cond = has_prev & (dhdt <= -dhdt_threshold)
+    if var_threshold is not None:
+        cond &= variance >= var_threshold
+    # Front montant : la condition n'était pas remplie à la mesure valide précédente
+    cond_prev = np.where(p >= 0, cond[rows, np.maximum(p, 0)], False)
+    st, tj = np.nonzero(cond & ~cond_prev)
+
+    _, qdlat, qdlon = _station_coords(matrix, "qd")
+    sep = pd.Timedelta(min_separation).value
+    keep, last = [], {}
+    for i, j in sorted(zip(st, tj), key=lambda x: (x[0], x[1])):
+        if i in last and t[j] - last[i] < sep:
             continue
-
-        # Calcul des différences avec la moyenne
-        df['delta_lumd'] = df['lumd'] - ref_lumd
-        df['next_time'] = df.index.to_series().shift(-1)
-        df['duration'] = (df['next_time'] - df.index.to_series()).fillna(pd.Timedelta(minutes=10))
-        df = df.dropna()
-
-        qd_lat = cam.qdlat
-        ax.barh(
-            y=[qd_lat] * len(df),
-            width=df["duration"],
-            left=df.index,
-            height=0.2,
-            color=cmap(norm(df["delta_lumd"])),
-            edgecolor="none"
-        )
-
-    ax.set_xlabel("Time (UTC)")
-    ax.set_ylabel("Magnetic QD Latitude (°)")
-    ax.set_ylim(lat_min, lat_max)
-    ax.xaxis.set_major_formatter(mdates.DateFormatter("%H:%M"))
-    ax.tick_params(axis='x', rotation=30)
-
-    sm = ScalarMappable(cmap=cmap, norm=norm)
-    sm.set_array([])
-    plt.colorbar(sm, ax=ax, label="Δ Brightness (mag/arcsec²) from 00:00–01:30 Mean")
-    plt.title("Brightness Variation by Magnetic QD Latitude")
-    plt.tight_layout()
-    out = f"{output_path}\\Delta_Brightness_mean.png"
-    plt.savefig(out, dpi=150)
-    plt.show()
-    plt.close()
-    print(out)
-    
-
-def main():
-    Fripon = load_fripon_data(r"C:\Users\Olivi\Documents\Doc\AurorAlpes\COMEA\Outils\Fripon\Ovalpes\fripon_data_complet.json")
-    Magnetometre = load_magneto_data(r"C:\Users\Olivi\Documents\Doc\AurorAlpes\COMEA\Outils\Fripon\Ovalpes\magneto_data.json")
-    output_path = r"C:\Users\Olivi\Documents\Doc\AurorAlpes\COMEA\Outils\Fripon\Ovalpes\graph\test"
-    last = {}
-    magnetos = list(Magnetometre.keys())
-    cameras = list(Fripon.keys())
-  
-    #CHOOSE DATETIME
-    x_min = pd.to_datetime("2024-05-10T21:00", format="%Y-%m-%dT%H:%M") #Put 21h30 to avoid day light
-    x_max = pd.to_datetime("2024-05-11T2:30", format="%Y-%m-%dT%H:%M")
-    
-    #CHOOSE BRIGHTNESS Y-AXIS LIMITS
-    y_min = 16                                                          
-    y_max = 21          #21.8 mag/arcsec² is a really dark sky
-
-    ############# CHOOSE WHAT TO PLOT ###############
-
-    # ploteuropetest(Fripon, cameras, Magnetometre, magnetos, x_min, x_max, y_min, y_max, output_path, last)                #PLOT MAP OF EUROPE
-    # ploteuropedelta(Fripon, cameras, Magnetometre, magnetos, x_min, x_max, y_min, y_max, output_path, last, ref_time_str="2024-05-10 21:40")
-    # plot_graph(Magnetometre, Fripon, x_min, x_max, y_min, y_max, output_path)                                         #PLOT GRAPH OF CLOSEST CAM AND MAG 
-    
-    ##STACK PLOT##
-    # stack_mags = ["ESK", "HAD", "CLF", "EBR"]         #Around 82,13 magnetic longitude
-    # stack_mags = ["HLP", "BEL", "PEG"]                #Around 104,27 magnetic longitude
-    # stack_mags = ["FUR", "THY"]                       #Around 97,37 magnetic longitude
-    # plot_graph_stack(Magnetometre, Fripon, x_min, x_max, y_min, y_max, stack_mags, output_path)                       #PLOT STACK GRAPH OF CLOSEST CAM AND MAG
-    
-    ##EXPERIMENTAL##
-    # plot_all_cameras(Fripon, x_min, x_max, y_min, y_max, lat_transition=46)                                             #ALL CAM IN ONE GRAPH (hard to read)
-    # plot_brightness_vs_qd_latitude(Fripon, x_min, x_max, lat_min=30, lat_max=52, y_min=y_min, y_max=y_max, output_path=output_path)
-    # plot_brightness_delta_vs_qd_latitude(Fripon, x_min, x_max, lat_min=30, lat_max=52, output_path=output_path)
-    # plot_brightness_delta_vs_qd_latitude_mean(Fripon, x_min, x_max, lat_min=30, lat_max=52, output_path=output_path)
+        last[i] = t[j]
+        keep.append((i, j))
+    st = np.array([i for i, _ in keep], dtype=int)
+    tj = np.array([j for _, j in keep], dtype=int)
+    events = pd.DataFrame({
+        "time":     matrix.times[tj],
+        "station":  [matrix.names[i] for i in st],
+        "qdlat":    qdlat[st],
+        "qdlon":    qdlon[st],
+        "dhdt":     dhdt[st, tj],
+        "variance": variance[st, tj],
+    }, columns=columns)
+    return events.sort_values(["time", "station"]).reset_index(drop=True)
+
+def _rolling_variance(matrix, window):
+    # Variance des mesures valides dans ]t - window, t], via sommes cumulées (données centrées par station)
+    t = matrix.times.as_unit('ns').asi8
+    x = np.where(matrix.mask, matrix.data, 0.0)
+    n_valid = matrix.mask.sum(axis=1)
+    x = np.where(matrix.mask, x - (x.sum(axis=1) / np.maximum(n_valid, 1))[:, None], 0.0)
+    zero = np.zeros((len(matrix), 1))
+    S1 = np.concatenate([zero, np.cumsum(x, axis=1)], axis=1)
+    S2 = np.concatenate([zero, np.cumsum(x * x, axis=1)], axis=1)
+    C  = np.concatenate([zero, np.cumsum(matrix.mask, axis=1)], axis=1)
+    j = np.arange(len(t))
+    j0 = np.searchsorted(t, t - window.value, side='right')
+    n = C[:, j + 1] - C[:, j0]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = (S1[:, j + 1] - S1[:, j0]) / n
+        var = (S2[:, j + 1] - S2[:, j0]) / n - mean ** 2
+    return np.where(matrix.mask & (n > 0), np.clip(var, 0, None), np.nan)
+
+class onsetdetectorclass:
+    """Version incrémentale de detect_onsets : état borné par station, O(taille de fenêtre) par mesure.
+
+    S'utilise seul (update) ou branché sur un livestoreclass (attach), les événements
+    étant alors émis au fil de l'ingestion et transmis à on_event s'il est fourni.
+    """
+    def __init__(self, dhdt_threshold=5.0, var_window="10min", var_threshold=None, min_separation="30min", on_event=None):
+        self.dhdt_threshold = dhdt_threshold
+        self.var_window     = pd.Timedelta(var_window).value
+        self.var_threshold  = var_threshold
+        self.min_separation = pd.Timedelta(min_separation).value
+        self.on_event       = on_event
+        self.events         = deque(maxlen=10000)
+        self._state         = {}   # station -> [dernier t, dernier H, condition précédente, dernier événement, fenêtre]
+
+    def update(self, name, times, values, qdlat=np.nan, qdlon=np.nan):
+        """Traite de nouvelles mesures (triées) d'une station ; retourne les événements émis."""
+        times = pd.DatetimeIndex(times).as_unit('ns').asi8 if not np.issubdtype(np.asarray(times).dtype, np.integer) else np.asarray(times)
+        st = self._state.setdefault(name, [None, np.nan, False, None, deque()])
+        out = []
+        for t, h in zip(times, np.asarray(values, dtype=float)):
+            if not np.isfinite(h) or (st[0] is not None and t <= st[0]):
+                continue
+            window = st[4]
+            window.append((t, h))
+            while window and window[0][0] <= t - self.var_window:
+                window.popleft()
+            variance = float(np.var([v for _, v in window]))
+            dhdt = np.nan if st[0] is None else (h - st[1]) / ((t - st[0]) / 60e9)
+            cond = st[0] is not None and dhdt <= -self.dhdt_threshold
+            if cond and self.var_threshold is not None:
+                cond = variance >= self.var_threshold
+            if cond and not st[2] and (st[3] is None or t - st[3] >= self.min_separation):
+                st[3] = t
+                event = {"time": pd.Timestamp(int(t)), "station": name, "qdlat": qdlat, "qdlon": qdlon,
+                         "dhdt": dhdt, "variance": variance}
+                out.append(event)
+                self.events.append(event)
+                if self.on_event is not None:
+                    self.on_event(event)
+            st[0], st[1], st[2] = t, h, cond
+        return out
+
+    def attach(self, store):
+        store.listeners.append(self._on_samples)
+        return self
+
+    def _on_samples(self, kind, station, times, values):
+        if kind == "magneto":
+            self.update(station.name, times, values, station.qdlat, station.qdlon)
+
+
+# --- Ingestion en continu (nowcasting) ---
+class ringbufferclass:
+    """Tampon circulaire de taille fixe des dernières mesures d'une station (mémoire constante)."""
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.times    = np.zeros(capacity, dtype=np.int64)   # ns depuis l'époque Unix
+        self.values   = np.full(capacity, np.nan)
+        self.size     = 0
+        self.head     = 0                                     # prochaine case écrite
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def last_time(self):
+        return self.times[(self.head - 1) % self.capacity] if self.size else np.iinfo(np.int64).min
+
+    def append(self, times, values):
+        """Ajoute des mesures triées ; celles qui ne sont pas plus récentes que la dernière sont ignorées."""
+        times, values = np.asarray(times, dtype=np.int64), np.asarray(values, dtype=float)
+        new = times > self.last_time
+        times, values = times[new][-self.capacity:], values[new][-self.capacity:]
+        pos = (self.head + np.arange(len(times))) % self.capacity
+        self.times[pos], self.values[pos] = times, values
+        self.head = (self.head + len(times)) % self.capacity
+        self.size = min(self.capacity, self.size + len(times))
+        return times, values
+
+    def ordered(self):
+        """(temps, valeurs) dans l'ordre chronologique."""
+        idx = (self.head - self.size + np.arange(self.size)) % self.capacity
+        return self.times[idx], self.values[idx]
+
+class _livestationclass:
+    """Station alimentée en continu ; se comporte comme cameraclass/magnetometerclass pour les tracés."""
+    def __init__(self, name, lat, lon, qdlat, qdlon, column, capacity, halflife):
+        self.name, self.lat, self.lon = name, float(lat), float(lon)
+        self.qdlat, self.qdlon = float(qdlat), float(qdlon)
+        self.column   = column
+        self.buffer   = ringbufferclass(capacity)
+        self.halflife = halflife
+        self.baseline = np.nan         # moyenne exponentielle glissante, mise à jour à chaque mesure
+        self.latest   = (None, np.nan)
+
+    @property
+    def df(self):
+        t, v = self.buffer.ordered()
+        return pd.DataFrame({self.column: v}, index=pd.DatetimeIndex(t.astype('datetime64[ns]')))
+
+    def update(self, times, values):
+        times, values = self.buffer.append(times, values)
+        if not len(times):
+            return 0
+        last_t = None if self.latest[0] is None else self.latest[0].value
+        for t, v in zip(times, values):
+            if not np.isfinite(v):
+                continue
+            if np.isnan(self.baseline):
+                self.baseline = v
+            else:
+                alpha = 1 - 0.5 ** ((t - last_t) / self.halflife)
+                self.baseline += alpha * (v - self.baseline)
+            last_t = t
+        self.latest = (pd.Timestamp(int(times[-1])), float(values[-1]))
+        return len(times)
+
+class livestoreclass:
+    """Ingestion incrémentale des flux FRIPON et magnétomètres.
+
+    Les nouvelles mesures (même schéma que les JSON d'archive, mais seulement les
+    nouveaux échantillons) sont ajoutées à des tampons circulaires de capacité fixe,
+    sans reparcourir l'historique. La latitude QD n'est calculée qu'à l'apparition
+    d'une station, la référence (moyenne exponentielle de demi-vie baseline_halflife
+    minutes) et la dernière valeur sont mises à jour à chaque mesure. cameras et
+    magnetos se comportent comme les dict Fripon et Magnetometre.
+    """
+    def __init__(self, capacity=1440, baseline_halflife=120, epoch=QD_EPOCH):
+        self.capacity = capacity
+        self.halflife = pd.Timedelta(minutes=baseline_halflife).value
+        self.epoch    = epoch
+        self.cameras  = {}
+        self.magnetos = {}
+        self.lock     = threading.Lock()
+        self.listeners = []   # fonctions (kind, station, temps, valeurs) appelées avec chaque nouvelle mesure,
+                              # sur le fil de l'ingestion une fois le verrou relâché (elles peuvent relire le store)
+
+    def _stations(self, kind):
+        if kind not in ("fripon", "magneto"):
+            raise ValueError(f"kind doit être 'fripon' ou 'magneto', pas {kind!r}")
+        return (self.cameras, 'lumd') if kind == "fripon" else (self.magnetos, 'H')
+
+    def ingest(self, payload, kind):
+        """Ajoute un lot {station: {lat, lon, lumd|time/valeur}} ; retourne le nombre de mesures nouvelles."""
+        stations, column = self._stations(kind)
+        events = []
+        with self.lock:
+            new = [n for n in payload if n not in stations]
+            if new:
+                qdlat, qdlon = get_qd_coords([float(payload[n]['lat']) for n in new],
+                                             [float(payload[n]['lon']) for n in new], self.epoch)
+                for n, qa, qo in zip(new, qdlat, qdlon):
+                    stations[n] = _livestationclass(n, payload[n]['lat'], payload[n]['lon'], qa, qo,
+                                                    column, self.capacity, self.halflife)
+            added = 0
+            for name, d in payload.items():
+                t_str, v = (list(d['lumd'].keys()), list(d['lumd'].values())) if kind == "fripon" else (d['time'], d['valeur'])
+                if not len(t_str):
+                    continue
+                t = pd.to_datetime(t_str, format="%Y%m%dT%H%M").as_unit('ns').asi8
+                order = np.argsort(t, kind='stable')
+                n_new = stations[name].update(t[order], np.asarray(v, dtype=float)[order])
+                added += n_new
+                if n_new and self.listeners:
+                    t_new, v_new = stations[name].buffer.ordered()   # copies
+                    events.append((stations[name], t_new[-n_new:], v_new[-n_new:]))
+        for station, t_new, v_new in events:
+            for listener in self.listeners:
+                listener(kind, station, t_new, v_new)
+        return added
+
+    def snapshot(self, kind="fripon", max_age=None, now=None, delta=False):
+        """Dernière valeur (ou écart à la référence si delta) de chaque station, NaN si trop ancienne."""
+        stations, _ = self._stations(kind)
+        with self.lock:
+            names = list(stations)
+            times = [stations[n].latest[0] for n in names]
+            vals = np.array([stations[n].latest[1] - (stations[n].baseline if delta else 0) for n in names])
+        if max_age is not None:
+            now = pd.Timestamp.now('UTC').tz_localize(None) if now is None else pd.Timestamp(now)
+            max_age = max_age if isinstance(max_age, pd.Timedelta) else pd.Timedelta(minutes=max_age)
+            stale = np.array([t is None or now - t > max_age for t in times], dtype=bool)
+            vals = np.where(stale, np.nan, vals)
+        return names, vals
+
+    def to_matrix(self, kind="fripon"):
+        """Matrice alignée des tampons, pour les cartes et keogrammes."""
+        stations, column = self._stations(kind)
+        with self.lock:
+            return stationmatrixclass.from_stations(stations, column)
+
+def _payload_kind(payload):
+    first = next(iter(payload.values()), {})
+    return "fripon" if 'lumd' in first else "magneto"
+
+def watch_directory(store, path, poll_interval=60, on_update=None, once=False):
+    """Surveille path et ingère chaque nouveau fichier .json (type déduit du contenu).
+
+    Les fichiers sont traités par ordre de nom ; un fichier déjà vu n'est relu que si sa
+    taille ou sa date de modification change. on_update(store, fichiers) est appelé après
+    chaque lot (par ex. pour rafraîchir la carte et les keogrammes).
+    """
+    seen = {}
+    while True:
+        batch = []
+        for name in sorted(os.listdir(path)):
+            full = os.path.join(path, name)
+            if not name.endswith(".json") or not os.path.isfile(full):
+                continue
+            stat = os.stat(full)
+            sig = (stat.st_size, stat.st_mtime_ns)
+            if seen.get(full) == sig:
+                continue
+            with open(full, 'r') as f:
+                payload = json.load(f)
+            if payload:
+                store.ingest(payload, _payload_kind(payload))
+            seen[full] = sig
+            batch.append(full)
+        if batch and on_update is not None:
+            on_update(store, batch)
+        if once:
+            return batch
+        time.sleep(poll_interval)
+
+def serve_ingest(store, host="127.0.0.1", port=8765):
+    """Point d'entrée HTTP local : POST /fripon ou /magneto (JSON d'un lot), GET /snapshot/<kind>."""
+    class _handler(BaseHTTPRequestHandler):
+        def _reply(self, code, body):
+            data = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            kind = self.path.strip("/")
+            if kind not in ("fripon", "magneto"):
+                return self._reply(404, {"error": f"type inconnu : {kind}"})
+            try:
+                payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                added = store.ingest(payload, kind)
+            except (ValueError, KeyError, TypeError) as e:   # JSON invalide, lat/lon/lumd absents...
+                return self._reply(400, {"error": f"{type(e).__name__} : {e}"})
+            self._reply(200, {"added": added})
+
+        def do_GET(self):
+            parts = self.path.strip("/").split("/")
+            if len(parts) != 2 or parts[0] != "snapshot" or parts[1] not in ("fripon", "magneto"):
+                return self._reply(404, {"error": "utiliser /snapshot/fripon ou /snapshot/magneto"})
+            names, vals = store.snapshot(parts[1])
+            self._reply(200, {n: (None if np.isnan(v) else float(v)) for n, v in zip(names, vals)})
+
+        def log_message(self, fmt, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), _handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Ingestion HTTP sur http://{host}:{port}")
+    return server
+
+
+# --- Pipeline : configuration, étapes partagées et cache disque ---
+DEFAULT_CONFIG = {
+    "fripon":      "fripon_data_complet.json",   # chemins relatifs au fichier de configuration
+    "magneto":     "magneto_data.json",
+    "output_path": "graph",
+    "x_min":       "2024-05-10T21:00",           # 21h30 pour éviter la lumière du jour
+    "x_max":       "2024-05-11T02:30",
+    "y_min":       16,
+    "y_max":       21,                           # 21.8 mag/arcsec² : ciel vraiment noir
+    "qd_epoch":    "2024-05-10",
+    "qd_height":   QD_HEIGHT,
+    "k":           3,
+    "coords":      "geo",
+    "baseline":    {"method": "nearest", "ref_time": "2024-05-10 21:40", "ref_start": None, "ref_end": None, "nights": 3,
+                    "tod_bin": "10min"},
+    "workers":     None,
+    "cache_dir":   None,                         # None : Ovalpes/cache
+    "plots":       [],
+}
+
+def load_config(path=None):
+    """Configuration du pipeline (JSON) complétée par DEFAULT_CONFIG, chemins résolus par rapport au fichier."""
+    config = json.loads(json.dumps(DEFAULT_CONFIG))
+    base = os.path.dirname(os.path.abspath(__file__))
+    if path is not None:
+        with open(path, 'r') as f:
+            user = json.load(f)
+        config["baseline"].update(user.pop("baseline", {}))
+        config.update(user)
+        base = os.path.dirname(os.path.abspath(path))
+    for key in ("fripon", "magneto", "output_path", "cache_dir"):
+        if config[key] is not None:
+            config[key] = os.path.join(base, config[key])
+    return config
+
+def _file_fingerprint(path):
+    st = os.stat(path)
+    return [os.path.abspath(path), st.st_size, st.st_mtime_ns]
+
+class pipelineclass:
+    """Exécute les tracés d'une configuration en partageant les étapes de calcul.
+
+    Chaque étape (chargement, QD + matrice alignée, associations, baseline) n'est calculée
+    qu'une fois par exécution et son résultat est mis en cache sur disque sous une clé
+    dérivée de ses paramètres et des clés de ses dépendances : une nouvelle exécution ne
+    refait que les étapes dont une entrée a changé.
+    """
+    # étape -> (dépendances, paramètres de configuration qui la définissent)
+    STAGES = {
+        "fripon":       ((), ("fripon",)),
+        "magneto":      ((), ("magneto",)),
+        "cameras":      (("fripon",), ("qd_epoch", "qd_height")),
+        "associations": (("magneto", "cameras"), ("k", "coords")),
+        "baseline":     (("cameras",), ("baseline",)),
+    }
+
+    def __init__(self, config, use_cache=True):
+        self.config    = config
+        self.use_cache = use_cache
+        self.cache_dir = os.path.join(config["cache_dir"] or CACHE_DIR, "pipeline")
+        self._results  = {}
+        self._keys     = {}
+
+    def key(self, stage):
+        """Empreinte d'une étape : ses paramètres, ses fichiers d'entrée et les empreintes de ses dépendances."""
+        if stage not in self._keys:
+            deps, params = self.STAGES[stage]
+            inputs = {p: self.config[p] for p in params}
+            for p in ("fripon", "magneto"):
+                if p in inputs:
+                    inputs[p] = _file_fingerprint(inputs[p])
+            inputs["deps"] = [self.key(d) for d in deps]
+            blob = json.dumps([stage, inputs], sort_keys=True, default=str).encode()
+            self._keys[stage] = hashlib.sha1(blob).hexdigest()[:16]
+        return self._keys[stage]
+
+    def get(self, stage):
+        """Résultat d'une étape : mémoire, sinon cache disque, sinon calcul (dépendances à la demande)."""
+        if stage in self._results:
+            return self._results[stage]
+        path = os.path.join(self.cache_dir, f"{stage}-{self.key(stage)}.pkl")
+        if self.use_cache and os.path.exists(path):
+            with open(path, 'rb') as f:
+                result = pickle.load(f)
+            print(f"[pipeline] {stage} : cache")
+        else:
+            with PROFILER.stage(f"pipeline.{stage}"):
+                result = getattr(self, f"_stage_{stage}")()
+            if self.use_cache:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                with open(path + ".tmp", 'wb') as f:
+                    pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(path + ".tmp", path)
+            print(f"[pipeline] {stage} : calculé")
+        self._results[stage] = result
+        if stage == "baseline":
+            self._prime_baseline(result)
+        return result
+
+    def _stage_fripon(self):
+        return load_fripon_data(self.config["fripon"])  # QD à l'époque choisie : étape "cameras"
+
+    def _stage_magneto(self):
+        return load_magneto_data(self.config["magneto"])
+
+    def _stage_cameras(self):
+        Fripon = set_qd_epoch(self.get("fripon"), pd.Timestamp(self.config["qd_epoch"]).to_pydatetime(), self.config["qd_height"])
+        return build_camera_matrix(Fripon)
+
+    def _stage_associations(self):
+        return closest_cam_from_mag(self.get("magneto"), self.get("cameras"), self.config["k"], coords=self.config["coords"])
+
+    def _stage_baseline(self):
+        b = self.config["baseline"]
+        return compute_baseline(self.get("cameras"), b["method"], b["ref_time"], b["ref_start"], b["ref_end"], b["nights"], b["tod_bin"])
+
+    def _prime_baseline(self, ref):
+        # Une baseline venue du cache est replacée sur la matrice pour que compute_delta la retrouve
+        b = self.config["baseline"]
+        self.get("cameras").baselines[_baseline_key(b["method"], b["ref_time"], b["ref_start"], b["ref_end"], b["nights"], b["tod_bin"])] = ref
+
+    def session(self):
+        if "session" not in self._results:
+            self._results["session"] = plotsessionclass(self.get("magneto"), self.get("cameras"), k=self.config["k"],
+                                                        coords=self.config["coords"], associations=self.get("associations"))
+        return self._results["session"]
+
+    def run(self, only=None):
+        """Produit les tracés de config["plots"] (ou seulement ceux dont le type est dans only)."""
+        c = self.config
+        x_min, x_max = pd.to_datetime(c["x_min"]), pd.to_datetime(c["x_max"])
+        os.makedirs(c["output_path"], exist_ok=True)
+        for spec in c["plots"]:
+            spec = dict(spec)
+            kind = spec.pop("type")
+            if only and kind not in only:
+                continue
+            if kind not in PIPELINE_PLOTS:
+                raise ValueError(f"type de tracé inconnu {kind!r}, attendu l'un de {sorted(PIPELINE_PLOTS)}")
+            print(f"[pipeline] tracé {kind}")
+            with PROFILER.stage(f"pipeline.plot.{kind}"):
+                PIPELINE_PLOTS[kind](self, x_min, x_max, **spec)
+
+def _qd_opts(config):
+    # Isolignes QD à la même époque / hauteur que les coordonnées QD des caméras
+    return {"qd_date": pd.Timestamp(config["qd_epoch"]).to_pydatetime(), "qd_height": config["qd_height"]}
+
+def _run_europe(pipe, x_min, x_max, qd_lines=False, **opts):
+    c, mags = pipe.config, pipe.get("magneto")
+    opts.setdefault("workers", c["workers"])
+    if qd_lines:
+        opts = {**_qd_opts(c), **opts}
+    fn = ploteuropetest if qd_lines else ploteurope
+    fn(pipe.get("cameras"), None, mags, list(mags), x_min, x_max, c["y_min"], c["y_max"], c["output_path"], **opts)
+
+def _run_europe_delta(pipe, x_min, x_max, **opts):
+    c, b, mags = pipe.config, pipe.config["baseline"], pipe.get("magneto")
+    pipe.get("baseline")
+    opts.setdefault("workers", c["workers"])
+    ploteuropedelta(pipe.get("cameras"), None, mags, list(mags), x_min, x_max, c["y_min"], c["y_max"], c["output_path"],
+                    ref_time_str=b["ref_time"], baseline=b["method"], ref_start=b["ref_start"], ref_end=b["ref_end"],
+                    nights=b["nights"], tod_bin=b["tod_bin"], **{**_qd_opts(c), **opts})
+
+def _run_pairs(pipe, x_min, x_max, **opts):
+    c = pipe.config
+    opts.setdefault("workers", c["workers"])
+    pipe.session().plot_pairs(x_min, x_max, c["y_min"], c["y_max"], c["output_path"], **opts)
+
+def _run_stacks(pipe, x_min, x_max, stacks, **opts):
+    c = pipe.config
+    opts.setdefault("workers", c["workers"])
+    pipe.session().plot_stacks(stacks, x_min, x_max, c["y_min"], c["y_max"], c["output_path"], **opts)
+
+def _run_all_cameras(pipe, x_min, x_max, **opts):
+    plot_all_cameras(pipe.get("cameras"), x_min, x_max, pipe.config["y_min"], pipe.config["y_max"],
+                     output_path=pipe.config["output_path"], **opts)
+
+def _run_keogram(pipe, x_min, x_max, lat_min=30, lat_max=52, **opts):
+    c = pipe.config
+    plot_brightness_vs_qd_latitude(pipe.get("cameras"), x_min, x_max, lat_min, lat_max, c["y_min"], c["y_max"], c["output_path"], **opts)
+
+def _run_keogram_delta(pipe, x_min, x_max, lat_min=30, lat_max=52, **opts):
+    # Référence propre à ce tracé (mesure la plus proche de ref_time dans la fenêtre affichée) :
+    # l'étape "baseline" n'est pas utilisée ; keogram_delta_mean accepte les autres méthodes
+    b = pipe.config["baseline"]
+    plot_brightness_delta_vs_qd_latitude(pipe.get("cameras"), x_min, x_max, lat_min, lat_max, pipe.config["output_path"],
+                                         ref_time_str=b["ref_time"], **opts)
+
+def _run_keogram_delta_mean(pipe, x_min, x_max, lat_min=30, lat_max=52, **opts):
+    plot_brightness_delta_vs_qd_latitude_mean(pipe.get("cameras"), x_min, x_max, lat_min, lat_max, pipe.config["output_path"], **opts)
+
+PIPELINE_PLOTS = {
+    "europe":             _run_europe,
+    "europe_delta":       _run_europe_delta,
+    "pairs":              _run_pairs,
+    "stacks":             _run_stacks,
+    "all_cameras":        _run_all_cameras,
+    "keogram":            _run_keogram,
+    "keogram_delta":      _run_keogram_delta,
+    "keogram_delta_mean": _run_keogram_delta_mean,
+}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Tracés FRIPON / magnétomètres décrits par un fichier de configuration JSON.")
+    parser.add_argument("config", nargs="?", help="fichier de configuration (voir config.example.json)")
+    parser.add_argument("--plot", action="append", choices=sorted(PIPELINE_PLOTS),
+                        help="ne produire que ce type de tracé (répétable)")
+    parser.add_argument("--x-min", help="début de la fenêtre, remplace x_min de la configuration")
+    parser.add_argument("--x-max", help="fin de la fenêtre, remplace x_max de la configuration")
+    parser.add_argument("--output", help="dossier de sortie, remplace output_path")
+    parser.add_argument("--workers", type=int, help="nombre de processus pour les tracés")
+    parser.add_argument("--show", action="store_true", help="affiche les figures interactives (sinon backend Agg, sans fenêtre)")
+    parser.add_argument("--no-cache", action="store_true", help="recalcule toutes les étapes sans lire ni écrire le cache")
+    parser.add_argument("--profile", action="store_true", help="affiche le temps par étape, les compteurs et le pic mémoire")
+    parser.add_argument("--profile-out", help="écrit les statistiques cProfile (pstats) dans ce fichier")
+    parser.add_argument("--trace-out", help="écrit une trace Chrome (chrome://tracing, Perfetto) dans ce fichier")
+    args = parser.parse_args(argv)
+
+    set_headless(not args.show)
+    config = load_config(args.config)
+    for key, value in (("x_min", args.x_min), ("x_max", args.x_max), ("workers", args.workers)):
+        if value is not None:
+            config[key] = value
+    if args.output is not None:
+        config["output_path"] = os.path.abspath(args.output)
+    if not config["plots"]:
+        parser.error("aucun tracé demandé : renseigner \"plots\" dans la configuration")
+    if args.profile or args.profile_out or args.trace_out:
+        PROFILER.enable(trace=bool(args.trace_out), cprofile=bool(args.profile_out))
+    try:
+        pipelineclass(config, use_cache=not args.no_cache).run(only=args.plot)
+    finally:
+        if PROFILER.enabled:
+            PROFILER.disable()
+            print(PROFILER.report())
+            if args.trace_out:
+                PROFILER.write_trace(args.trace_out)
+            if args.profile_out:
+                PROFILER.write_pstats(args.profile_out)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,240 @@
+"""Jeux de données synthétiques FRIPON / magnétomètres et banc de mesure des performances.
+
+    python benchmark.py generate --cameras 100 --magnetos 16 --days 2 --output synth/
+    python benchmark.py run --scales 20 100 500 --output benchmark_results.json
+    python benchmark.py run --compare benchmark_results.json --tolerance 0.25
+
+Les fichiers générés suivent exactement le schéma JSON de fripon_data*.json et de
+magneto_data.json. Les résultats sont écrits en JSON (une entrée par mesure et par
+échelle) ; --compare signale, et fait échouer la commande, toute mesure plus lente que
+la référence au-delà de la tolérance.
+"""
+import os
+import argparse
+import datetime
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import matplotlib
+matplotlib.use("Agg")
+
+import Ovalpes as ov
+
+TIME_FORMAT = "%Y%m%dT%H%M"
+
+# --- Génération ---
+def _station_positions(rng, n, lat_range=(36.0, 58.0), lon_range=(-10.0, 25.0)):
+    return rng.uniform(*lat_range, n), rng.uniform(*lon_range, n)
+
+def _sample_times(rng, start, days, cadence, gap_rate, outage_rate, outage_len):
+    # Instants de mesure : pertes isolées (gap_rate) et coupures de outage_len échantillons (outage_rate)
+    times = pd.date_range(start, start + pd.Timedelta(days=days), freq=cadence, inclusive="left")
+    keep = rng.random(len(times)) >= gap_rate
+    for s in np.nonzero(rng.random(len(times)) < outage_rate)[0]:
+        keep[s:s + outage_len] = False
+    return times[keep]
+
+def make_fripon(n_cameras, start="2024-05-10", days=1, cadence="10min", gap_rate=0.02, outage_rate=0.002,
+                outage_len=12, seed=0):
+    """Caméras synthétiques au format de fripon_data_complet.json (luminosité en mag/arcsec²)."""
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp(start)
+    lats, lons = _station_positions(rng, n_cameras)
+    data = {}
+    for i, (lat, lon) in enumerate(zip(lats, lons)):
+        times = _sample_times(rng, start, days, cadence, gap_rate, outage_rate, outage_len)
+        # Nuit noire (~21) autour de 0 h locale, jour très clair, plus une baisse « aurorale » aux hautes latitudes
+        local_h = (times.hour + times.minute / 60 + lon / 15) % 24
+        night = np.cos((local_h / 24) * 2 * np.pi)
+        lumd = 14 + 7 * np.clip(night + 0.3, 0, 1) + rng.normal(0, 0.05, len(times))
+        lumd -= np.clip(lat - 44, 0, None) * 0.15 * np.exp(-((local_h - 23) / 1.5) ** 2)
+        data[f"SY{i:04d}"] = {
+            "lon": float(lon), "lat": float(lat),
+            "x0": int(rng.integers(400, 900)), "y0": int(rng.integers(300, 700)),
+            "lumd": dict(zip(times.strftime(TIME_FORMAT), lumd.tolist())),
+        }
+    return data
+
+def make_magneto(n_magnetos, start="2024-05-10", days=1, cadence="1min", gap_rate=0.01, outage_rate=0.001,
+                 outage_len=30, seed=1):
+    """Magnétomètres synthétiques au format de magneto_data.json (composante H en nT)."""
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp(start)
+    lats, lons = _station_positions(rng, n_magnetos)
+    data = {}
+    for i, (lat, lon) in enumerate(zip(lats, lons)):
+        times = _sample_times(rng, start, days, cadence, gap_rate, outage_rate, outage_len)
+        t_h = (times - start).total_seconds().to_numpy() / 3600
+        H = 19000 + 40 * (lat - 36) + np.cumsum(rng.normal(0, 0.5, len(times)))
+        H -= (lat - 30) * 8 * np.exp(-((t_h % 24 - 22) / 1.0) ** 2)   # baie de sous-orage en soirée
+        data[f"M{i:03d}"] = {
+            "lon": f"{lon:.4f}", "lat": f"{lat:.4f}",
+            "time": times.strftime(TIME_FORMAT).tolist(), "valeur": H.tolist(),
+        }
+    return data
+
+def write_dataset(output_dir, n_cameras, n_magnetos, start="2024-05-10", days=1, cam_cadence="10min",
+                  mag_cadence="1min", gap_rate=0.02, seed=0):
+    """Écrit fripon_data_complet.json et magneto_data.json dans output_dir ; retourne leurs chemins."""
+    os.makedirs(output_dir, exist_ok=True)
+    fripon_file = os.path.join(output_dir, "fripon_data_complet.json")
+    magneto_file = os.path.join(output_dir, "magneto_data.json")
+    with open(fripon_file, "w") as f:
+        json.dump(make_fripon(n_cameras, start, days, cam_cadence, gap_rate, seed=seed), f)
+    with open(magneto_file, "w") as f:
+        json.dump(make_magneto(n_magnetos, start, days, mag_cadence, gap_rate / 2, seed=seed + 1), f)
+    return fripon_file, magneto_file
+
+# --- Mesures ---
+def _timeit(fn, repeat, setup=None):
+    durations = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        t0 = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - t0)
+    return durations
+
+def _cold_qd():
+    # Caches QD vidés : chaque répétition mesure une vraie conversion AACGM
+    ov._qd_cache.clear()
+    ov._qd_lines_cache.clear()
+
+def _benchmarks(workdir, fripon_file, magneto_file, frames):
+    Fripon = ov.load_fripon_data(fripon_file, cache_dir=None)
+    Magnetometre = ov.load_magneto_data(magneto_file)
+    matrix = ov.build_camera_matrix(Fripon)
+    lats = [c.lat for c in Fripon.values()]
+    lons = [c.lon for c in Fripon.values()]
+    date = ov.QD_EPOCH
+    x_min, x_max = matrix.times[0], matrix.times[-1]
+
+    def render_frames():
+        snap = matrix.snapshots(matrix.times[:frames])
+        europe = ov.europemapclass(matrix.lon, matrix.lat, "Greys", ov.colors.Normalize(16, 21), "Brightness")
+        try:
+            for j, t in enumerate(matrix.times[:frames]):
+                europe.render(snap[j], t.strftime("%Y-%m-%d %H:%M"))
+        finally:
+            europe.close()
+
+    return {
+        "load_fripon_data":     (lambda: ov.load_fripon_data(fripon_file, cache_dir=None), _cold_qd),
+        "load_magneto_data":    (lambda: ov.load_magneto_data(magneto_file), None),
+        "get_qd_latitude":      (lambda: [ov.get_qd_latitude(la, lo, date) for la, lo in zip(lats, lons)], None),
+        "get_qd_coords":        (lambda: ov.get_qd_coords(lats, lons, date, cache_dir=None), _cold_qd),
+        "find_lat_for_lon":     (lambda: [ov.find_lat_for_lon(lo, 45, 110, 0.1, 0.1, date) for lo in np.linspace(-10, 25, 10)], None),
+        "compute_qd_lines":     (lambda: ov.compute_qd_lines(range(30, 65, 5), np.linspace(-40, 60, 300), date, cache_dir=None), _cold_qd),
+        "build_camera_matrix":  (lambda: ov.build_camera_matrix(Fripon), None),
+        "closest_cam_from_mag": (lambda: ov.closest_cam_from_mag(Magnetometre, matrix, 3), None),
+        "build_keogram":        (lambda: ov.build_keogram(matrix, x_min, x_max, 30, 52), None),
+        "render_frames":        (render_frames, None),
+    }
+
+def run_benchmarks(scales, days=1, repeat=3, frames=10, only=None, seed=0):
+    """Génère un jeu synthétique par échelle (nombre de caméras) et chronomètre chaque étape."""
+    results = []
+    for n_cameras in scales:
+        n_magnetos = max(4, n_cameras // 6)
+        with tempfile.TemporaryDirectory(prefix="ovalpes-bench-") as workdir:
+            fripon_file, magneto_file = write_dataset(workdir, n_cameras, n_magnetos, days=days, seed=seed)
+            for name, (fn, setup) in _benchmarks(workdir, fripon_file, magneto_file, frames).items():
+                if only and name not in only:
+                    continue
+                entry = {"benchmark": name, "scale": n_cameras, "n_cameras": n_cameras, "n_magnetos": n_magnetos,
+                         "days": days, "repeat": repeat}
+                try:
+                    durations = _timeit(fn, repeat, setup)
+                    entry.update(min_s=min(durations), median_s=statistics.median(durations),
+                                 mean_s=statistics.fmean(durations))
+                    print(f"{name:<22} {n_cameras:>6} caméras  médiane {entry['median_s'] * 1000:10.1f} ms")
+                except Exception as exc:  # ex. fonds Natural Earth indisponibles hors ligne
+                    entry["error"] = f"{type(exc).__name__}: {exc}"
+                    print(f"{name:<22} {n_cameras:>6} caméras  échec : {entry['error']}")
+                results.append(entry)
+    return results
+
+def _metadata():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "date": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "matplotlib": matplotlib.__version__,
+    }
+
+def compare_results(results, reference, tolerance):
+    """Mesures dont la médiane dépasse celle de la référence de plus de tolerance (fraction)."""
+    ref = {(r["benchmark"], r["scale"]): r for r in reference["results"] if "median_s" in r}
+    regressions = []
+    for r in results:
+        old = ref.get((r["benchmark"], r["scale"]))
+        if old is not None and "median_s" in r and r["median_s"] > old["median_s"] * (1 + tolerance):
+            regressions.append({"benchmark": r["benchmark"], "scale": r["scale"],
+                                "reference_s": old["median_s"], "median_s": r["median_s"],
+                                "ratio": r["median_s"] / old["median_s"]})
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Données synthétiques et banc de performances d'Ovalpes.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    gen = sub.add_parser("generate", help="écrit un jeu de données synthétique")
+    gen.add_argument("--cameras", type=int, default=100)
+    gen.add_argument("--magnetos", type=int, default=16)
+    gen.add_argument("--start", default="2024-05-10")
+    gen.add_argument("--days", type=float, default=1)
+    gen.add_argument("--cam-cadence", default="10min")
+    gen.add_argument("--mag-cadence", default="1min")
+    gen.add_argument("--gap-rate", type=float, default=0.02, help="proportion de mesures manquantes")
+    gen.add_argument("--seed", type=int, default=0)
+    gen.add_argument("--output", default="synthetic")
+
+    run = sub.add_parser("run", help="chronomètre les étapes principales à plusieurs échelles")
+    run.add_argument("--scales", type=int, nargs="+", default=[20, 100, 500], help="nombres de caméras")
+    run.add_argument("--days", type=float, default=1)
+    run.add_argument("--repeat", type=int, default=3)
+    run.add_argument("--frames", type=int, default=10, help="images rendues par render_frames")
+    run.add_argument("--only", nargs="+", help="ne lancer que ces mesures")
+    run.add_argument("--seed", type=int, default=0)
+    run.add_argument("--output", default="benchmark_results.json")
+    run.add_argument("--compare", help="résultats de référence (JSON) à comparer")
+    run.add_argument("--tolerance", type=float, default=0.25, help="ralentissement toléré (0.25 = +25 %%)")
+    args = parser.parse_args(argv)
+
+    if args.command == "generate":
+        paths = write_dataset(args.output, args.cameras, args.magnetos, args.start, args.days,
+                              args.cam_cadence, args.mag_cadence, args.gap_rate, args.seed)
+        print("\n".join(paths))
+        return 0
+
+    results = run_benchmarks(args.scales, args.days, args.repeat, args.frames, args.only, args.seed)
+    report = {"metadata": _metadata(), "results": results}
+    if args.compare:
+        with open(args.compare, "r") as f:
+            report["regressions"] = compare_results(results, json.load(f), args.tolerance)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Résultats écrits dans {args.output}")
+    for r in report.get("regressions", []):
+        print(f"RÉGRESSION {r['benchmark']} ({r['scale']} caméras) : {r['reference_s']:.4f} s -> {r['median_s']:.4f} s (x{r['ratio']:.2f})")
+    return 1 if report.get("regressions") else 0
+
+if __name__ == "__main__":
+    sys.exit(main())